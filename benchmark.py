@@ -0,0 +1,216 @@
+"""
+CPU benchmarks on synthetic data with randomly initialized weights, no
+dataset or checkpoint needed.
+
+Every benchmark is timed per call after a few warmup calls and reported
+as images/sec with the p50/p99 call latency, for each batch size and
+intra-op thread count of the sweep:
+
+    get_image      decoding a batch of pngs with `utils.get_image`
+    train_step     one D update and two G updates, as in `GAN.train`
+    sampler        a forward pass of `GAN.sampler`
+    completion     one iteration of the in-graph completion loop
+    kl_init        the kl-divergence initialization rounds of `GAN.test`
+    save_images    writing a batch grid with `utils.save_images`
+
+Results are appended to `--outPath`, one json object per line, with the
+commit and the machine they were measured on:
+
+    python benchmark.py --batchSizes 1 16 64 --threads 1 2 4 --outPath bench.jsonl
+"""
+from __future__ import division
+from __future__ import print_function
+import os
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+import tensorflow as tf
+from six.moves import xrange
+
+from model import GAN
+from utils import get_image, save_images, rgb2gray, kl_divergence_rows
+
+BENCHMARKS = ['get_image', 'train_step', 'sampler', 'completion', 'kl_init', 'save_images']
+# benchmarks that do not run tensorflow ops, measured once per batch size
+NUMPY_BENCHMARKS = ['get_image', 'save_images']
+
+
+def latency_stats(times, batch_size):
+    times = np.asarray(times)
+    return {'iters': len(times),
+            'images_per_sec': batch_size * len(times) / times.sum(),
+            'mean_ms': 1e3 * times.mean(),
+            'p50_ms': 1e3 * np.percentile(times, 50),
+            'p99_ms': 1e3 * np.percentile(times, 99)}
+
+
+def time_calls(fn, iters, warmup):
+    for _ in xrange(warmup):
+        fn()
+    times = []
+    for _ in xrange(iters):
+        start_time = time.time()
+        fn()
+        times.append(time.time() - start_time)
+    return times
+
+
+def environment():
+    """Where the results were measured, stored with every result."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'host': platform.node(), 'cpu': platform.processor() or platform.machine(),
+            'cpu_count': multiprocessing.cpu_count(), 'python': platform.python_version(),
+            'tensorflow': tf.__version__}
+
+
+class Synthetic(object):
+    """Random inputs of `model`, and pngs of random images in a
+    temporary directory for the numpy benchmarks."""
+    def __init__(self, image_shape, z_dim, text_vector_dim, max_batch, seed=0):
+        rng = np.random.RandomState(seed)
+        self.images = rng.uniform(-1, 1, [max_batch] + image_shape).astype(np.float32)
+        self.z = rng.uniform(-1, 1, [max_batch, z_dim]).astype(np.float32)
+        self.t = np.sign(rng.uniform(-1, 1, [max_batch, text_vector_dim])).astype(np.float32)
+        self.t_wr = np.sign(rng.uniform(-1, 1, [max_batch, text_vector_dim])).astype(np.float32)
+        self.dir = tempfile.mkdtemp(prefix='stext2image_bench_')
+        self.files = []
+        for i in xrange(max_batch):
+            path = os.path.join(self.dir, '%04d.png' % i)
+            save_images(self.images[i:i+1], [1, 1], path)
+            self.files.append(path)
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def numpy_benchmark(name, data, batch_size, image_size):
+    if name == 'get_image':
+        files = data.files[:batch_size]
+        return lambda: [get_image(f, image_size, is_crop=False) for f in files]
+    rows = int(np.ceil(batch_size / 8))
+    path = os.path.join(data.dir, 'grid.png')
+    images = data.images[:batch_size]
+    return lambda: save_images(images, [rows, min(8, batch_size)], path)
+
+
+class ModelBenchmarks(object):
+    """The tensorflow benchmarks on one randomly initialized model; the
+    batch dimension of the graph is open, so all batch sizes share it."""
+    def __init__(self, sess, args):
+        self.model = model = GAN(sess,
+                                 image_size=args.imgSize,
+                                 text_vector_dim=args.text_vector_dim,
+                                 lam1=args.lam1,
+                                 lam2=args.lam2,
+                                 fused_discriminator=args.fusedDiscriminator,
+                                 d_bn_stats=args.dBnStats,
+                                )
+        d_opt = tf.train.AdamOptimizer(0.0002, beta1=0.5)
+        g_opt = tf.train.AdamOptimizer(0.0002, beta1=0.5)
+        self.d_optim = d_opt.minimize(model.d_loss, var_list=model.d_vars)
+        self.g_optim = g_opt.minimize(model.g_loss, var_list=model.g_vars)
+        model.build_completion(args.lr, args.momentum)
+        tf.initialize_all_variables().run()
+        self.init_rounds = args.initRounds
+
+    def __call__(self, name, data, batch_size):
+        model, sess = self.model, self.model.sess
+        feed = {model.images: data.images[:batch_size], model.z: data.z[:batch_size],
+                model.t: data.t[:batch_size], model.t_wr: data.t_wr[:batch_size]}
+        g_feed = {model.z: data.z[:batch_size], model.t: data.t[:batch_size]}
+
+        if name == 'train_step':
+            def step():
+                sess.run(self.d_optim, feed_dict=feed)
+                sess.run(self.g_optim, feed_dict=g_feed)
+                sess.run([self.g_optim, model.g_loss], feed_dict=g_feed)
+            return step
+        if name == 'sampler':
+            return lambda: sess.run(model.sampler, feed_dict=g_feed)
+        if name == 'completion':
+            sess.run(model.c_load, feed_dict=feed)
+            c_feed = {model.c_steps: 1, model.c_active: np.ones(batch_size, dtype=np.float32)}
+            return lambda: sess.run([model.c_last_loss, model.c_last_grad, model.c_step], feed_dict=c_feed)
+
+        # kl_init, as in `GAN.test`
+        size = model.image_size
+        in_flat = rgb2gray(data.images[:batch_size, :, :size, :]).reshape(batch_size, -1) + 1
+        def kl_init():
+            zhats = np.random.uniform(-1, 1, size=(self.init_rounds, batch_size, model.z_dim)).astype(np.float32)
+            kl_all = np.empty((self.init_rounds, batch_size))
+            for i in xrange(self.init_rounds):
+                G_imgs = sess.run(model.G, feed_dict={ model.z: zhats[i], model.t: data.t[:batch_size] })
+                kl_all[i] = kl_divergence_rows(in_flat, rgb2gray(G_imgs[:,:,:size,:]).reshape(batch_size, -1) + 1)
+            return zhats[np.argmin(kl_all, 0), np.arange(batch_size)]
+        return kl_init
+
+
+def report(out, result):
+    print(" [*] %-12s batch %4d threads %3s: %9.1f images/s, p50 %8.2f ms, p99 %8.2f ms" % (
+        result['benchmark'], result['batch_size'], result['threads'], result['images_per_sec'],
+        result['p50_ms'], result['p99_ms']))
+    out.write(json.dumps(result, sort_keys=True) + '\n')
+    out.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument('--batchSizes', nargs='+', type=int, default=[1, 16, 64])
+    parser.add_argument('--threads', nargs='+', type=int, default=[1, 2, 4]) # intra-op thread counts, 0 for the tensorflow default
+    parser.add_argument('--iters', type=int, default=10) # timed calls per benchmark
+    parser.add_argument('--warmup', type=int, default=2) # untimed calls before them
+    parser.add_argument('--initRounds', type=int, default=30) # kl_init rounds per call
+    parser.add_argument('--imgSize', type=int, default=64)
+    parser.add_argument('--text_vector_dim', type=int, default=18)
+    parser.add_argument('--lam1', type=float, default=100)
+    parser.add_argument('--lam2', type=float, default=1)
+    parser.add_argument('--lr', type=float, default=0.001)
+    parser.add_argument('--momentum', type=float, default=0.9)
+    parser.add_argument('--fusedDiscriminator', action='store_true') # train_step with one discriminator pass over real, fake and wrong batches
+    parser.add_argument('--dBnStats', type=str, choices=['split', 'joint'], default='split') # batch norm statistics of the fused pass
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--outPath', type=str, default='benchmark.jsonl') # results are appended, one json object per line
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    env = environment()
+    env['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    env['fused_discriminator'] = args.fusedDiscriminator
+    env['d_bn_stats'] = args.dBnStats if args.fusedDiscriminator else None
+    image_shape = [args.imgSize, args.imgSize * 2, 3]
+    data = Synthetic(image_shape, 100, args.text_vector_dim, max(args.batchSizes), args.seed)
+
+    with open(args.outPath, 'a') as out:
+        try:
+            for name in [b for b in args.benchmarks if b in NUMPY_BENCHMARKS]:
+                for batch_size in args.batchSizes:
+                    times = time_calls(numpy_benchmark(name, data, batch_size, args.imgSize),
+                                       args.iters, args.warmup)
+                    report(out, dict(env, benchmark=name, batch_size=batch_size, threads=None,
+                                     **latency_stats(times, batch_size)))
+
+            tf_benchmarks = [b for b in args.benchmarks if b not in NUMPY_BENCHMARKS]
+            for threads in args.threads if tf_benchmarks else []:
+                config = tf.ConfigProto(device_count={'GPU': 0}, intra_op_parallelism_threads=threads)
+                with tf.Graph().as_default(), tf.Session(config=config) as sess:
+                    tf.set_random_seed(args.seed)
+                    benchmarks = ModelBenchmarks(sess, args)
+                    for name in tf_benchmarks:
+                        for batch_size in args.batchSizes:
+                            times = time_calls(benchmarks(name, data, batch_size), args.iters, args.warmup)
+                            report(out, dict(env, benchmark=name, batch_size=batch_size, threads=threads,
+                                             **latency_stats(times, batch_size)))
+        finally:
+            data.close()
+    print(" [*] Appended results to %s" % args.outPath)
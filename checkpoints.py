@@ -0,0 +1,129 @@
+"""
+Resumable training checkpoints written off the training thread.
+
+`TrainCheckpointer.save` copies every variable (weights, moving averages
+and the Adam slots) into snapshot variables with one session call, then a
+background thread writes the snapshot while training goes on. The
+snapshot is saved under the names of the original variables, so
+`GAN.load` and test.py read these checkpoints like any other.
+
+Each checkpoint also stores the training state under `train_state/`:
+the step counter, the position (epoch and batch) of the next batch, the
+batch seed, the numpy global RNG state and the fixed `sample_z`/`sample_t`
+used for sample images. Retention is the saver's: the last `max_to_keep`
+checkpoints plus one every `keep_every_hours`.
+"""
+from __future__ import print_function
+import os
+import threading
+import traceback
+import numpy as np
+import tensorflow as tf
+
+STATE_SCOPE = 'train_state'
+
+
+def rng_state_arrays():
+    """The numpy global RNG state as arrays, see `set_rng_state`."""
+    _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {'rng_keys': keys.astype(np.int64),
+            'rng_pos': np.array([pos, has_gauss], dtype=np.int64),
+            'rng_gauss': np.array([cached_gaussian], dtype=np.float64)}
+
+
+def set_rng_state(state):
+    np.random.set_state(('MT19937', state['rng_keys'].astype(np.uint32),
+                         int(state['rng_pos'][0]), int(state['rng_pos'][1]),
+                         float(state['rng_gauss'][0])))
+
+
+class TrainCheckpointer(object):
+    """Saves `variables` with a training state of fixed-shape arrays
+    `state_shapes` (name -> (shape, dtype)); see the module docstring."""
+    def __init__(self, sess, variables, state_shapes, checkpoint_dir, model_name='GAN',
+                 max_to_keep=5, keep_every_hours=10000., use_thread=True):
+        self.sess = sess
+        self.variables = list(variables)
+        self.checkpoint_dir = checkpoint_dir
+        self.model_name = model_name
+        self.use_thread = use_thread
+        self._thread = None
+        self._error = None
+        self.save_time = 0.
+
+        with tf.name_scope('snapshot'):
+            self.snapshots = [tf.Variable(tf.zeros(v.get_shape(), dtype=v.dtype.base_dtype),
+                                          trainable=False, collections=[], name=v.op.name)
+                              for v in self.variables]
+            self.state_values = dict((k, tf.placeholder(dtype, shape)) for k, (shape, dtype)
+                                     in state_shapes.items())
+            self.state_vars = dict((k, tf.Variable(tf.zeros(shape, dtype=dtype), trainable=False,
+                                                   collections=[], name=STATE_SCOPE + '_' + k))
+                                   for k, (shape, dtype) in state_shapes.items())
+            self.snapshot = tf.group(*([tf.assign(s, v) for s, v in zip(self.snapshots, self.variables)] +
+                                       [tf.assign(self.state_vars[k], p)
+                                        for k, p in self.state_values.items()]))
+
+        var_list = dict((v.op.name, s) for v, s in zip(self.variables, self.snapshots))
+        var_list.update(('%s/%s' % (STATE_SCOPE, k), v) for k, v in self.state_vars.items())
+        self.saver = tf.train.Saver(var_list, max_to_keep=max_to_keep,
+                                    keep_checkpoint_every_n_hours=keep_every_hours)
+
+    def _write(self, step):
+        try:
+            self.saver.save(self.sess, os.path.join(self.checkpoint_dir, self.model_name),
+                            global_step=step)
+        except Exception:
+            self._error = traceback.format_exc()
+            print(" [!] checkpoint %d failed:\n%s" % (step, self._error))
+
+    def wait(self):
+        """Waits for the checkpoint being written; re-raises its error."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            raise RuntimeError("checkpoint failed:\n" + self._error)
+
+    def save(self, step, state):
+        """Snapshots the variables and `state` now and writes them as
+        checkpoint `step`, in the background unless `use_thread` is off."""
+        if not os.path.exists(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        # the snapshot variables are still being read by the previous save
+        self.wait()
+        self.sess.run(self.snapshot, feed_dict=dict((self.state_values[k], state[k]) for k in state))
+        if self.use_thread:
+            self._thread = threading.Thread(target=self._write, args=(step,))
+            self._thread.start()
+        else:
+            self._write(step)
+
+    def restore(self):
+        """Restores the latest checkpoint of `checkpoint_dir`. Returns its
+        training state, {} for a checkpoint without one (only the
+        variables it has are restored), or None without a checkpoint."""
+        print(" [*] Reading checkpoints...")
+        ckpt = tf.train.get_checkpoint_state(self.checkpoint_dir)
+        if not (ckpt and ckpt.model_checkpoint_path):
+            return None
+        path = ckpt.model_checkpoint_path
+        reader = tf.train.NewCheckpointReader(path)
+        saved = reader.get_variable_to_shape_map()
+        present = [v for v in self.variables if v.op.name in saved]
+        tf.train.Saver(present).restore(self.sess, path)
+        if len(present) < len(self.variables):
+            print(" [*] %s has %d of %d variables, the others keep their initial values"
+                  % (path, len(present), len(self.variables)))
+
+        state = {}
+        for k in self.state_vars:
+            name = '%s/%s' % (STATE_SCOPE, k)
+            if name in saved:
+                state[k] = reader.get_tensor(name)
+        if len(state) < len(self.state_vars):
+            return {}
+        return state
+
+    def close(self):
+        self.wait()
@@ -0,0 +1,59 @@
+"""
+Helpers for the latent-space completion loop of `GAN.test`.
+"""
+from __future__ import division
+import numpy as np
+
+
+class ConvergenceTracker(object):
+    """Per-sample stopping criteria for the completion loop.
+
+    A sample is frozen once any enabled criterion holds:
+        tol/patience: its loss improved by less than `tol` (relative to its
+                      best loss so far) on `patience` consecutive checks.
+                      Enabled when either is > 0, patience defaults to 1.
+        grad_tol:     the norm of its gradient fell below `grad_tol`.
+        max_iters:    it has run `max_iters` iterations (scalar or per sample).
+    """
+    def __init__(self, n, tol=0., grad_tol=0., patience=0, max_iters=None, active=None):
+        self.tol = tol
+        self.grad_tol = grad_tol
+        self.patience = max(patience, 1) if tol > 0 or patience > 0 else 0
+        self.max_iters = max_iters
+        self.best = np.full(n, np.inf)
+        self.stale = np.zeros(n, dtype=np.int64)
+        self.iters = np.zeros(n, dtype=np.int64)
+        self.stop_iter = np.full(n, -1, dtype=np.int64)
+        self.active = np.ones(n, dtype=bool) if active is None else np.array(active, dtype=bool)
+
+    def update(self, loss, grad=None, steps=1, rows=None):
+        """Record the per-sample `loss` (and gradient rows `grad`) at the
+        current iterate, `steps` iterations after the previous check.
+        `rows` are the samples the entries belong to, all by default.
+        Returns the mask of the entries frozen by this check."""
+        loss = np.asarray(loss)
+        rows = np.arange(len(self.active)) if rows is None else np.asarray(rows)
+        active = self.active[rows]
+        stop = np.zeros_like(active)
+        self.iters[rows[active]] += steps
+        if self.patience:
+            best = self.best[rows]
+            seen = np.isfinite(best)
+            improved = ~seen
+            improved[seen] = loss[seen] < best[seen] - self.tol*np.abs(best[seen])
+            self.stale[rows] = np.where(improved, 0, self.stale[rows] + 1)
+            stop |= self.stale[rows] >= self.patience
+        self.best[rows] = np.minimum(self.best[rows], loss)
+        if self.grad_tol > 0 and grad is not None:
+            grad = np.asarray(grad).reshape(len(loss), -1)
+            stop |= np.sqrt(np.sum(grad**2, axis=1)) < self.grad_tol
+        if self.max_iters is not None:
+            stop |= self.iters[rows] >= np.broadcast_to(self.max_iters, self.iters.shape)[rows]
+
+        stop &= active
+        self.active[rows[stop]] = False
+        self.stop_iter[rows[stop]] = self.iters[rows[stop]]
+        return stop
+
+    def done(self):
+        return not self.active.any()
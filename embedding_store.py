@@ -0,0 +1,157 @@
+"""
+Memory-mapped text/attribute embedding store.
+
+A store directory holds the float32 embedding matrix (`embeddings.f32`)
+and `index.json`, which maps image filenames to matrix rows. Batches are
+fetched by fancy indexing the mapped matrix, so tables larger than RAM
+work and lookups cost no per-image Python work once the rows of a file
+list are resolved.
+
+Build a store from a pickled table with:
+
+    python embedding_store.py --text_path datasets/celeba/imAttrs.pkl \
+        --outDir datasets/celeba/attr_store datasets/celeba/train datasets/celeba/test
+
+A pickled dict {filename: vector} is stored with its own keys; a pickled
+array is indexed with the CelebA rule (row = first six filename
+characters - 1) for every png in the given directories; without
+directories it stores no index and applies the rule at lookup time.
+"""
+from __future__ import division
+from __future__ import print_function
+import os
+import json
+import pickle
+import argparse
+from glob import glob
+import numpy as np
+
+MATRIX_NAME = 'embeddings.f32'
+INDEX_NAME = 'index.json'
+
+
+def filename_row(filename):
+    """Row of `filename` in a CelebA-style table, numbered from 000001."""
+    name = os.path.basename(filename)
+    try:
+        return int(name[0:6]) - 1
+    except ValueError:
+        raise ValueError("cannot derive a table row from filename '%s'" % name)
+
+
+class EmbeddingStore(object):
+    def __init__(self, matrix=None, index=None, store_dir=None):
+        """Use `EmbeddingStore.open` or `EmbeddingStore.from_pickle`."""
+        self._matrix = matrix
+        self.index = index
+        self.store_dir = store_dir
+
+    @classmethod
+    def open(cls, store_dir):
+        with open(os.path.join(store_dir, INDEX_NAME), 'r') as f:
+            meta = json.load(f)
+        store = cls(index=meta['index'], store_dir=store_dir)
+        store.shape = (meta['count'], meta['dim'])
+        return store
+
+    @classmethod
+    def from_pickle(cls, text_path):
+        """In-memory store over a pickled table, rows found by `filename_row`."""
+        table = pickle.load(open(text_path, 'rb'))
+        if isinstance(table, dict):
+            names = sorted(table)
+            matrix = np.array([table[n] for n in names], dtype=np.float32)
+            return cls(matrix, dict((n, i) for i, n in enumerate(names)))
+        return cls(np.asarray(table, dtype=np.float32))
+
+    def __getstate__(self):
+        # worker processes reopen the memory map instead of copying it
+        state = self.__dict__.copy()
+        if self.store_dir is not None:
+            state['_matrix'] = None
+        return state
+
+    @property
+    def matrix(self):
+        if self._matrix is None:
+            self._matrix = np.memmap(os.path.join(self.store_dir, MATRIX_NAME), dtype=np.float32,
+                                     mode='r', shape=self.shape)
+        return self._matrix
+
+    def __len__(self):
+        return len(self.matrix)
+
+    @property
+    def dim(self):
+        return self.matrix.shape[1]
+
+    def rows(self, filenames):
+        """Matrix rows of `filenames`; unknown names raise instead of
+        silently yielding no embedding."""
+        names = [os.path.basename(f) for f in filenames]
+        if self.index is None:
+            rows = [filename_row(n) for n in names]
+        else:
+            missing = [n for n in names if n not in self.index]
+            if missing:
+                raise KeyError("%d files are not in the embedding store, e.g. %s"
+                               % (len(missing), ', '.join(missing[:3])))
+            rows = [self.index[n] for n in names]
+        rows = np.array(rows, dtype=np.int64)
+        if len(rows) and (rows.min() < 0 or rows.max() >= len(self)):
+            raise IndexError("embedding rows out of range [0, %d)" % len(self))
+        return rows
+
+    def take(self, rows):
+        """float32 embeddings of `rows`."""
+        return np.asarray(self.matrix[rows], dtype=np.float32)
+
+    def mean(self, chunk_size=65536):
+        """Column means, streamed over the mapped matrix."""
+        total = np.zeros(self.dim, dtype=np.float64)
+        for l in range(0, len(self), chunk_size):
+            total += np.sum(self.matrix[l:l+chunk_size], 0, dtype=np.float64)
+        return total / len(self)
+
+
+def build_embedding_store(text_path, store_dir, image_dirs=()):
+    table = pickle.load(open(text_path, 'rb'))
+    if isinstance(table, dict):
+        names = sorted(table)
+        index = dict((n, i) for i, n in enumerate(names))
+        count, dim = len(names), len(np.asarray(table[names[0]]).ravel())
+        rows = (table[n] for n in names)
+    else:
+        table = np.asarray(table)
+        count, dim = table.shape
+        # without directories `rows` falls back to `filename_row`
+        index = {} if image_dirs else None
+        for image_dir in image_dirs:
+            for image_path in glob(os.path.join(image_dir, '*.png')):
+                index[os.path.basename(image_path)] = filename_row(image_path)
+        bad = [n for n, r in (index or {}).items() if not 0 <= r < count]
+        if bad:
+            raise IndexError("%d files map outside the %d-row table, e.g. %s"
+                             % (len(bad), count, ', '.join(sorted(bad)[:3])))
+        rows = iter(table)
+
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    with open(os.path.join(store_dir, MATRIX_NAME), 'wb') as f:
+        for row in rows:
+            f.write(np.asarray(row, dtype=np.float32).ravel().tobytes())
+    with open(os.path.join(store_dir, INDEX_NAME), 'w') as f:
+        json.dump({'count': count, 'dim': dim, 'index': index}, f)
+    print(" [*] Embedding store %s: %d x %d, %s" % (store_dir, count, dim,
+          'rows by filename' if index is None else '%d indexed files' % len(index)))
+    return EmbeddingStore.open(store_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--text_path', type=str, default='text_embeddings.pkl')
+    parser.add_argument('--outDir', type=str, required=True)
+    parser.add_argument('imgDirs', type=str, nargs='*') # pngs to index for an array table, none to find rows by filename
+    args = parser.parse_args()
+
+    build_embedding_store(args.text_path, args.outDir, args.imgDirs)
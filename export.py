@@ -0,0 +1,155 @@
+"""
+Frozen, inference-only generator export.
+
+Restores a checkpoint into the full graph, then keeps only the nodes the
+sampler needs (and, with --withLoss, the completion loss and its gradient
+with respect to z), turns the variables into constants and writes the
+result as one GraphDef file with a small json description next to it:
+
+    python export.py --checkpointDir checkpoints_face_pretrained --text_vector_dim 18 \
+        --lam1 100 --lam2 1 --outPath generator.pb --withLoss
+
+The discriminator towers used only for training, the optimizer slots,
+summaries and moving-average updates are left out. With --foldBN the
+exported generator is `GAN.build_folded_sampler`, batch norm folded into
+the deconv weights, after checking it against the sampler.
+`FrozenGenerator` loads the file without building the model or touching a
+checkpoint.
+"""
+from __future__ import division
+from __future__ import print_function
+import os
+import json
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import graph_util
+
+from model import GAN
+
+INPUTS = {'z': 'z:0', 't': 't:0', 'images': 'real_images:0'}
+OUTPUTS = {'generated': 'generated:0',
+           'complete_loss': 'complete_loss:0',
+           'complete_grad': 'complete_grad:0',
+           'complete_G': 'complete_G:0'}
+
+
+def meta_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def build_export_outputs(model, with_loss=False, fold_bn=False):
+    """Named output tensors of `model`'s inference graph.
+
+    The completion loss is built like the loop of `GAN.build_completion`
+    (batch statistics, no moving-average updates), so it freezes into
+    pure functions of z, t and the images. `fold_bn` exports
+    `model.folded_sampler`, which must have been built.
+    """
+    sampler = model.folded_sampler if fold_bn else model.sampler
+    outputs = [tf.identity(sampler, name='generated')]
+    if with_loss:
+        G, loss = model.completion_loss(model.z, model.t, model.images)
+        outputs += [tf.identity(loss, name='complete_loss'),
+                    tf.identity(tf.gradients(loss, model.z)[0], name='complete_grad'),
+                    tf.identity(G, name='complete_G')]
+    return outputs
+
+
+def export_generator(model, out_path, with_loss=False, fold_bn=False):
+    """Freezes the restored `model` (its session holds the trained values)
+    into `out_path`."""
+    outputs = build_export_outputs(model, with_loss, fold_bn)
+    names = [o.op.name for o in outputs]
+    graph_def = graph_util.convert_variables_to_constants(
+        model.sess, model.sess.graph.as_graph_def(), names)
+
+    with tf.gfile.GFile(out_path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    meta = {'inputs': dict((k, v) for k, v in INPUTS.items() if with_loss or k != 'images'),
+            'outputs': dict((k, v) for k, v in OUTPUTS.items() if with_loss or k == 'generated'),
+            'image_size': model.image_size,
+            'z_dim': model.z_dim,
+            'text_vector_dim': model.text_vector_dim,
+            'with_loss': with_loss,
+            'fold_bn': fold_bn}
+    with open(meta_path(out_path), 'w') as f:
+        json.dump(meta, f, indent=2)
+    print(" [*] Exported %d nodes (%.1f MB) to %s" % (
+        len(graph_def.node), os.path.getsize(out_path) / 2.**20, out_path))
+    return graph_def
+
+
+class FrozenGenerator(object):
+    """Runs an exported generator in its own graph and session."""
+    def __init__(self, path, config=None):
+        with open(meta_path(path), 'r') as f:
+            self.meta = json.load(f)
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.sess = tf.Session(graph=self.graph, config=config)
+        self.inputs = dict((k, self.graph.get_tensor_by_name(v)) for k, v in self.meta['inputs'].items())
+        self.outputs = dict((k, self.graph.get_tensor_by_name(v)) for k, v in self.meta['outputs'].items())
+
+    def generate(self, z, t):
+        return self.sess.run(self.outputs['generated'],
+                             feed_dict={self.inputs['z']: z, self.inputs['t']: t})
+
+    def complete_loss(self, z, t, images):
+        """Per-sample completion loss, its gradient w.r.t. z and the
+        generated images."""
+        if not self.meta['with_loss']:
+            raise ValueError("generator was exported without --withLoss")
+        return self.sess.run([self.outputs['complete_loss'], self.outputs['complete_grad'],
+                              self.outputs['complete_G']],
+                             feed_dict={self.inputs['z']: z, self.inputs['t']: t,
+                                        self.inputs['images']: images})
+
+    def close(self):
+        self.sess.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--imgSize', type=int, default=64)
+    parser.add_argument('--text_vector_dim', type=int, default=100)
+    parser.add_argument('--lam1', type=float, default=0.1) # completion loss weights, used with --withLoss
+    parser.add_argument('--lam2', type=float, default=0.1)
+    parser.add_argument('--checkpointDir', type=str, default='checkpoint')
+    parser.add_argument('--outPath', type=str, default='generator.pb')
+    parser.add_argument('--withLoss', action='store_true') # also export the completion loss and its gradient
+    parser.add_argument('--foldBN', action='store_true') # fold batch norm into the generator's deconv weights
+    parser.add_argument('--foldTol', type=float, default=1e-4) # largest accepted difference from the unfolded sampler
+    args = parser.parse_args()
+
+    assert(os.path.exists(args.checkpointDir))
+
+    with tf.Session() as sess:
+        model = GAN(sess,
+                    image_size=args.imgSize,
+                    text_vector_dim=args.text_vector_dim,
+                    checkpoint_dir=args.checkpointDir,
+                    lam1=args.lam1,
+                    lam2=args.lam2,
+                    inference=True,
+                   )
+        isLoaded = model.load(args.checkpointDir)
+        assert(isLoaded)
+        if args.foldBN:
+            model.build_folded_sampler()
+            model.check_folded_sampler(atol=args.foldTol)
+        export_generator(model, args.outPath, args.withLoss, args.foldBN)
+
+    # check that the export loads and runs on its own
+    start_time = time.time()
+    generator = FrozenGenerator(args.outPath)
+    z = np.random.uniform(-1, 1, [1, generator.meta['z_dim']]).astype(np.float32)
+    t = np.zeros([1, generator.meta['text_vector_dim']], dtype=np.float32)
+    generator.generate(z, t)
+    print(" [*] Loaded and ran the export in %.2fs" % (time.time() - start_time))
+    generator.close()
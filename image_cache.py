@@ -0,0 +1,146 @@
+"""
+Memory-mapped cache of decoded training images.
+
+The cache directory holds a raw uint8 array of shape [N, h, w, 3]
+(`images.u8`) and a json manifest recording, for every source png, its
+name, size, mtime and the row it occupies. Rebuilding only decodes files
+that are new or whose size/mtime changed.
+"""
+from __future__ import division
+from __future__ import print_function
+import os
+import json
+from glob import glob
+import numpy as np
+
+from utils import imread, center_crop
+
+MANIFEST_NAME = 'manifest.json'
+IMAGES_NAME = 'images.u8'
+MANIFEST_VERSION = 1
+
+
+def decode_image(image_path, image_size, is_crop=False):
+    img = imread(image_path)
+    if is_crop:
+        img = center_crop(img, image_size)
+    return np.clip(np.round(img), 0, 255).astype(np.uint8)
+
+
+def read_manifest(cache_dir):
+    path = os.path.join(cache_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(cache_dir, manifest):
+    path = os.path.join(cache_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.rename(path + '.tmp', path)
+
+
+def build_image_cache(dataset_dir, cache_dir, image_size=64, is_crop=False, pattern='*.png'):
+    """Create or incrementally update the image cache for `dataset_dir`.
+
+    Returns the opened `ImageCache`.
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    images_path = os.path.join(cache_dir, IMAGES_NAME)
+
+    image_paths = sorted(glob(os.path.join(dataset_dir, pattern)))
+    assert(len(image_paths) > 0)
+
+    manifest = read_manifest(cache_dir)
+    if manifest is not None and (manifest['version'] != MANIFEST_VERSION or
+                                 manifest['image_size'] != image_size or
+                                 manifest['is_crop'] != is_crop or
+                                 not os.path.exists(images_path) or
+                                 os.path.getsize(images_path) < manifest['count'] * int(np.prod(manifest['shape']))):
+        print(" [!] Cache parameters changed or images missing, rebuilding %s" % cache_dir)
+        manifest = None
+    if manifest is None:
+        shape = list(decode_image(image_paths[0], image_size, is_crop).shape)
+        manifest = {'version': MANIFEST_VERSION, 'image_size': image_size, 'is_crop': is_crop,
+                    'shape': shape, 'count': 0, 'files': []}
+        open(images_path, 'wb').close()
+
+    shape = tuple(manifest['shape'])
+    # an interrupted update leaves bytes past the manifest's rows, drop
+    # them so that new rows are appended where the manifest numbers them
+    with open(images_path, 'r+b') as f:
+        f.truncate(manifest['count'] * int(np.prod(shape)))
+
+    old_entries = dict((e['name'], e) for e in manifest['files'])
+    entries, appended, changed = [], [], []
+    for image_path in image_paths:
+        st = os.stat(image_path)
+        name = os.path.basename(image_path)
+        entry = {'name': name, 'size': st.st_size, 'mtime': st.st_mtime}
+        old = old_entries.get(name)
+        if old is None:
+            entry['row'] = manifest['count'] + len(appended)
+            appended.append(image_path)
+        else:
+            entry['row'] = old['row']
+            if old['size'] != entry['size'] or old['mtime'] != entry['mtime']:
+                changed.append((entry['row'], image_path))
+        entries.append(entry)
+
+    def decode(image_path):
+        img = decode_image(image_path, image_size, is_crop)
+        if img.shape != shape:
+            raise ValueError("%s has shape %s, cache expects %s" % (image_path, img.shape, shape))
+        return img
+
+    if changed:
+        images = np.memmap(images_path, dtype=np.uint8, mode='r+',
+                           shape=(manifest['count'],) + shape)
+        for row, image_path in changed:
+            images[row] = decode(image_path)
+        images.flush()
+        del images
+
+    with open(images_path, 'ab') as f:
+        for i, image_path in enumerate(appended):
+            f.write(decode(image_path).tobytes())
+            if (i+1) % 1000 == 0:
+                print(" [*] Cached %d/%d new images" % (i+1, len(appended)))
+
+    removed = len(old_entries) - (len(entries) - len(appended))
+    manifest['count'] += len(appended)
+    manifest['files'] = entries
+    write_manifest(cache_dir, manifest)
+    print(" [*] Image cache %s: %d images (%d new, %d changed, %d removed)"
+          % (cache_dir, len(entries), len(appended), len(changed), removed))
+
+    return ImageCache(cache_dir)
+
+
+class ImageCache(object):
+    def __init__(self, cache_dir):
+        manifest = read_manifest(cache_dir)
+        if manifest is None:
+            raise IOError("No image cache found in %s, build it with --build_cache" % cache_dir)
+        self.cache_dir = cache_dir
+        self.shape = tuple(manifest['shape'])
+        self.files = [e['name'] for e in manifest['files']]
+        self.rows = np.array([e['row'] for e in manifest['files']], dtype=np.int64)
+        self.images = np.memmap(os.path.join(cache_dir, IMAGES_NAME), dtype=np.uint8,
+                                mode='r', shape=(manifest['count'],) + self.shape)
+
+    def __len__(self):
+        return len(self.files)
+
+    def get_images(self, idx):
+        """Images for manifest positions `idx` (slice or index array), as
+        float32 in [-1, 1] like `utils.get_image`."""
+        rows = self.rows[idx]
+        if len(rows) > 1 and np.all(np.diff(rows) == 1):
+            batch = self.images[rows[0]:rows[-1]+1]
+        else:
+            batch = self.images[rows]
+        return batch.astype(np.float32) / 127.5 - 1.
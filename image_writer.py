@@ -0,0 +1,77 @@
+"""
+Background writer for sample, completion and gif outputs.
+"""
+from __future__ import print_function
+import threading
+import traceback
+import numpy as np
+from six.moves import queue
+from six.moves import xrange
+
+from utils import save_images, make_gif
+
+
+class AsyncImageWriter(object):
+    """Encodes and writes images on `num_workers` threads so the training
+    and completion loops do not wait on png encoding and disk I/O.
+
+    At most `max_pending` jobs are queued; submitting blocks while the queue
+    is full. `close` (also run at exit by the callers) waits for every
+    queued job. The first worker error is re-raised by `flush`/`close`.
+    With `num_workers=0` every job runs synchronously on the caller.
+    """
+    def __init__(self, num_workers=2, max_pending=16):
+        self.num_workers = num_workers
+        self._queue = queue.Queue(max_pending)
+        self._error = None
+        self._closed = False
+        self._workers = [threading.Thread(target=self._work) for _ in xrange(num_workers)]
+        for w in self._workers:
+            w.daemon = True
+            w.start()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                fn, args = job
+                fn(*args)
+            except Exception:
+                if self._error is None:
+                    self._error = traceback.format_exc()
+                print(" [!] image writer job failed:\n" + traceback.format_exc())
+            finally:
+                self._queue.task_done()
+
+    def submit(self, fn, *args):
+        if self._closed:
+            raise RuntimeError("image writer is closed")
+        if self.num_workers == 0:
+            fn(*args)
+        else:
+            self._queue.put((fn, args))
+
+    def save_images(self, images, size, image_path):
+        # copy, the caller may reuse its buffers
+        self.submit(save_images, np.array(images, copy=True), size, image_path)
+
+    def make_gif(self, images, fname, duration=2, true_image=False):
+        self.submit(make_gif, np.array(images, copy=True), fname, duration, true_image)
+
+    def flush(self):
+        self._queue.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("image writer job failed:\n" + error)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._workers:
+            self._queue.put(None)
+        for w in self._workers:
+            w.join()
+        self.flush()
@@ -0,0 +1,182 @@
+"""
+Background prefetching of training batches.
+
+`BatchMaker` builds the ready-to-feed float32 arrays of one batch and
+`BatchPrefetcher` runs it on a pool of worker threads or processes,
+keeping a bounded number of batches ready while the session trains.
+"""
+from __future__ import division
+from __future__ import print_function
+import time
+import threading
+import traceback
+import multiprocessing
+import numpy as np
+from six.moves import xrange
+from six.moves import queue
+
+from utils import get_image
+from image_cache import ImageCache
+
+
+class BatchMaker(object):
+    """Builds the (images, z, t, t_wr) feeds of training batch `(epoch, idx)`.
+
+    Each batch draws from its own RandomState seeded with (seed, epoch, idx),
+    so its content does not depend on which worker builds it.
+    """
+    def __init__(self, image_files, text_store, text_rows, negatives, batch_size, z_dim,
+                 image_size=64, is_crop=False, cache_dir=None, seed=0, cache_positions=None):
+        self.image_files = image_files
+        self.text_store = text_store
+        self.text_rows = text_rows
+        self.negatives = negatives
+        self.batch_size = batch_size
+        self.z_dim = z_dim
+        self.image_size = image_size
+        self.is_crop = is_crop
+        self.cache_dir = cache_dir
+        # manifest positions of image_files in the cache, None if they are all of it in order
+        self.cache_positions = cache_positions
+        self.seed = seed
+        self._cache = None
+
+    def __getstate__(self):
+        # the memory map is reopened in each worker process
+        state = self.__dict__.copy()
+        state['_cache'] = None
+        return state
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = ImageCache(self.cache_dir)
+        return self._cache
+
+    def __call__(self, job):
+        epoch, idx = job
+        rng = np.random.RandomState([self.seed, epoch, idx])
+        l, u = idx*self.batch_size, (idx+1)*self.batch_size
+
+        batch_files = self.image_files[l:u]
+        if self.cache_dir:
+            positions = slice(l, u) if self.cache_positions is None else self.cache_positions[l:u]
+            batch_images = self.cache.get_images(positions)
+        else:
+            batch = [get_image(batch_file, self.image_size, is_crop=self.is_crop)
+                     for batch_file in batch_files]
+            batch_images = np.array(batch).astype(np.float32)
+
+        batch_z = rng.uniform(-1, 1, [self.batch_size, self.z_dim]).astype(np.float32)
+
+        batch_t = self.text_store.take(self.text_rows[l:u])
+
+        # wrong attributes, see negatives.NegativeSampler
+        batch_t_wr = self.negatives(batch_t, rng)
+
+        return batch_images, batch_z, batch_t, batch_t_wr
+
+
+def _work(make_batch, jobs, results):
+    while True:
+        item = jobs.get()
+        if item is None:
+            break
+        seq, job = item
+        try:
+            results.put((seq, job, make_batch(job), None))
+        except Exception:
+            results.put((seq, job, None, traceback.format_exc()))
+
+
+class BatchPrefetcher(object):
+    """Runs `make_batch` over `jobs` on `num_workers` threads (or processes)
+    and hands the batches back in job order through `get`.
+
+    At most `queue_size + num_workers` batches are in flight or waiting, no
+    new jobs are handed out while the consumer is that far behind. `get`
+    must be called once per job.
+    """
+    def __init__(self, make_batch, jobs, num_workers=2, queue_size=8, use_processes=False):
+        if use_processes:
+            self._jobs = multiprocessing.Queue(num_workers)
+            self._results = multiprocessing.Queue()
+            Worker = multiprocessing.Process
+        else:
+            self._jobs = queue.Queue(num_workers)
+            self._results = queue.Queue()
+            Worker = threading.Thread
+
+        # every job in flight or waiting to be consumed holds a slot
+        self._slots = threading.Semaphore(queue_size + num_workers)
+        self._stop = threading.Event()
+        self._pending = {}
+        self._next_seq = 0
+
+        self.num_batches = 0
+        self.wait_time = 0.
+        self.last_wait = 0.
+        self.depth = 0
+        self._depth_sum = 0
+
+        self._workers = [Worker(target=_work, args=(make_batch, self._jobs, self._results))
+                         for _ in xrange(num_workers)]
+        for w in self._workers:
+            w.daemon = True
+            w.start()
+        self._feeder = threading.Thread(target=self._feed, args=(jobs,))
+        self._feeder.daemon = True
+        self._feeder.start()
+
+    def _feed(self, jobs):
+        for seq, job in enumerate(jobs):
+            self._slots.acquire()
+            if self._stop.is_set():
+                return
+            self._jobs.put((seq, job))
+        for _ in self._workers:
+            self._jobs.put(None)
+
+    def _ready(self):
+        try:
+            queued = self._results.qsize()
+        except NotImplementedError:
+            queued = 0
+        return len(self._pending) + queued
+
+    def get(self):
+        """Returns `(job, batch)` for the next job, blocking if it is not ready."""
+        self.depth = self._ready()
+        start_time = time.time()
+        while self._next_seq not in self._pending:
+            seq, job, batch, error = self._results.get()
+            if error is not None:
+                self.close()
+                raise RuntimeError("batch %s failed in a prefetch worker:\n%s" % (job, error))
+            self._pending[seq] = (job, batch)
+        job, batch = self._pending.pop(self._next_seq)
+        self._next_seq += 1
+        self._slots.release()
+
+        self.last_wait = time.time() - start_time
+        self.wait_time += self.last_wait
+        self.num_batches += 1
+        self._depth_sum += self.depth
+        return job, batch
+
+    def stats(self):
+        """Queue depth and starvation (time `get` spent blocked) so far."""
+        n = max(self.num_batches, 1)
+        return {'batches': self.num_batches,
+                'depth': self.depth,
+                'mean_depth': self._depth_sum / n,
+                'wait_time': self.wait_time,
+                'mean_wait': self.wait_time / n}
+
+    def close(self):
+        self._stop.set()
+        self._slots.release()
+        for w in self._workers:
+            if isinstance(w, multiprocessing.Process):
+                w.terminate()
+                w.join()
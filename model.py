@@ -9,14 +9,25 @@
 from __future__ import division
 import os
 import time
+import atexit
 from glob import glob
 import tensorflow as tf
-import pickle
 from six.moves import xrange
-from scipy.stats import entropy
 
 from ops import *
 from utils import *
+from image_cache import ImageCache
+from input_pipeline import BatchMaker, BatchPrefetcher
+from summaries import ScalarAccumulator
+from negatives import NegativeSampler
+from embedding_store import EmbeddingStore
+from completion import ConvergenceTracker
+from image_writer import AsyncImageWriter
+from trajectories import PngOutput, StoreOutput
+from quantize import load_quant_ranges, int8_weights
+from parallel import average_gradients, ParameterAverager
+from checkpoints import TrainCheckpointer, rng_state_arrays, set_rng_state
+from profiling import PhaseTimer, JsonlLog, Tracer, parse_steps
 
 #import pdb
 
@@ -25,7 +36,8 @@ class GAN(object):
                  batch_size=64, text_vector_dim=100,
                  z_dim=100, t_dim=256, gf_dim=64, df_dim=64, c_dim=3,
                  checkpoint_dir=None, sample_dir=None, log_dir=None, 
-                 lam1=0.1, lam2=0.1, lam3=0.1):
+                 lam1=0.1, lam2=0.1, lam3=0.1, inference=False,
+                 fused_discriminator=False, d_bn_stats='split'):
         """
 
         Args:
@@ -39,6 +51,10 @@ class GAN(object):
             lam1: (optional) Hyperparameter for contextual loss. [0.1]
             lam2: (optional) Hyperparameter for perceptual loss. [0.1]
             lam3: (optional) Hyperparameter for wrong examples [0.1]
+            inference: (optional) Build only what completion and sampling need, see `build_inference_model`. [False]
+            fused_discriminator: (optional) Run D once over the real, fake and wrong-text batches concatenated. [False]
+            d_bn_stats: (optional) With fused_discriminator, normalize the three batches with their own
+                (split) or shared (joint) batch norm statistics. [split]
         """
         self.sess = sess
         self.is_crop = is_crop
@@ -77,34 +93,54 @@ class GAN(object):
         self.checkpoint_dir = checkpoint_dir
         self.sample_dir = sample_dir
         self.log_dir = log_dir
+        self.inference = inference
+        assert(d_bn_stats in ('split', 'joint'))
+        self.fused_discriminator = fused_discriminator
+        self.d_bn_stats = d_bn_stats
         
-        self.build_model()
+        if inference:
+            self.build_inference_model()
+        else:
+            self.build_model()
 
         self.model_name = "GAN"
 
         
     def build_model(self):
+        # the batch dimension is left open, any number of images can be fed
         self.images = tf.placeholder(
-            tf.float32, [self.batch_size] + self.image_shape, name='real_images')
+            tf.float32, [None] + self.image_shape, name='real_images')
         self.sample_images= tf.placeholder(
-            tf.float32, [self.batch_size] + self.image_shape, name='sample_images')
+            tf.float32, [None] + self.image_shape, name='sample_images')
 
-        self.z = tf.placeholder(tf.float32, [self.batch_size, self.z_dim], name='z')
+        self.z = tf.placeholder(tf.float32, [None, self.z_dim], name='z')
         self.z_sum = tf.summary.histogram("z", self.z)
 
-        self.t = tf.placeholder(tf.float32, [self.batch_size, self.text_vector_dim], name='t')
+        self.t = tf.placeholder(tf.float32, [None, self.text_vector_dim], name='t')
         self.t_sum = tf.summary.histogram("t", self.t)
 
-        self.t_wr = tf.placeholder(tf.float32, [self.batch_size, self.text_vector_dim], name='t_wr')
+        self.t_wr = tf.placeholder(tf.float32, [None, self.text_vector_dim], name='t_wr')
         self.t_wr_sum = tf.summary.histogram("t_wr", self.t_wr)
 
         #self.images_wr = tf.placeholder(
         #    tf.float32, [self.batch_size] + self.image_shape, name='wrong_images')
 
         self.G = self.generator(self.z, self.t)
-        self.D_rl, self.D_logits_rl = self.discriminator(self.images, self.t)
-        self.D_fk, self.D_logits_fk = self.discriminator(self.G, self.t, reuse=True)
-        self.D_wr, self.D_logits_wr = self.discriminator(self.images, self.t_wr, reuse=True)
+        if self.fused_discriminator:
+            # one pass over [real, fake, wrong text], 3 * batch_size images
+            D, D_logits = self.discriminator(tf.concat(0, [self.images, self.G, self.images]),
+                                             tf.concat(0, [self.t, self.t, self.t_wr]),
+                                             bn_groups=3 if self.d_bn_stats == 'split' else 1)
+            self.D_rl, self.D_fk, self.D_wr = tf.split(0, 3, D)
+            self.D_logits_rl, self.D_logits_fk, self.D_logits_wr = tf.split(0, 3, D_logits)
+            # the G updates only need D(G): a separate pass over the fake
+            # batch alone, batch statistics only, as in `build_fused_step`
+            _, g_logits = self.discriminator(self.G, self.t, reuse=True, update_ema=False)
+        else:
+            self.D_rl, self.D_logits_rl = self.discriminator(self.images, self.t)
+            self.D_fk, self.D_logits_fk = self.discriminator(self.G, self.t, reuse=True)
+            self.D_wr, self.D_logits_wr = self.discriminator(self.images, self.t_wr, reuse=True)
+            g_logits = self.D_logits_fk
 
         self.sampler = self.sampler(self.z, self.t)
 
@@ -115,8 +151,8 @@ class GAN(object):
 
         # cross entropy loss
         self.g_loss = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(self.D_logits_fk,
-                                                    tf.ones_like(self.D_fk)))
+            tf.nn.sigmoid_cross_entropy_with_logits(g_logits,
+                                                    tf.ones_like(g_logits)))
         self.d_loss_real = tf.reduce_mean(
             tf.nn.sigmoid_cross_entropy_with_logits(self.D_logits_rl,
                                                     tf.ones_like(self.D_rl)))
@@ -149,7 +185,8 @@ class GAN(object):
         self.d_vars = [var for var in t_vars if 'd_' in var.name]
         self.g_vars = [var for var in t_vars if 'g_' in var.name]
 
-        self.saver = tf.train.Saver(max_to_keep=50)
+        self.model_variables = tf.global_variables()
+        self.saver = tf.train.Saver(self.model_variables, max_to_keep=50)
 
         # mask to generate
         self.mask = tf.placeholder(tf.float32, [None] + self.image_shape, name='mask')
@@ -160,66 +197,214 @@ class GAN(object):
         #        tf.abs(tf.mul(self.mask, self.G) - tf.mul(self.mask, self.images))), 1)
         
         # kl divergence
-        self.contextual_loss = kl_divergence(
-            tf.divide(tf.add(tf.contrib.layers.flatten(tf.image.rgb_to_grayscale(
-                tf.slice(self.G, [0,0,0,0], [self.batch_size,self.image_size,self.image_size,self.c_dim]))), 1), 2),
-            tf.divide(tf.add(tf.contrib.layers.flatten(tf.image.rgb_to_grayscale(
-                tf.slice(self.images, [0,0,0,0], [self.batch_size,self.image_size,self.image_size,self.c_dim]))), 1), 2))
+        self.contextual_loss = self.contextual_kl(self.G, self.images)
         
         self.perceptual_loss = self.g_loss
         self.complete_loss = self.lam1*self.contextual_loss + self.lam2*self.perceptual_loss
         self.grad_complete_loss = tf.gradients(self.complete_loss, self.z)
 
+
+    def build_inference_model(self):
+        """The generator, the sampler and the discriminator applied once to
+        the generator's output, without summaries, the real and wrong-text
+        branches or the losses of training. The saver only covers the
+        variables of this graph (no discriminator moving averages or
+        optimizer slots), which it restores from any training checkpoint."""
+        self.images = tf.placeholder(
+            tf.float32, [None] + self.image_shape, name='real_images')
+        self.z = tf.placeholder(tf.float32, [None, self.z_dim], name='z')
+        self.t = tf.placeholder(tf.float32, [None, self.text_vector_dim], name='t')
+
+        # the generator's moving averages are created as in training, the
+        # sampler and the exports read them
+        self.G = self.generator(self.z, self.t)
+        # creates the discriminator variables for the perceptual loss of
+        # `completion_loss`, batch statistics only
+        self.D_fk, self.D_logits_fk = self.discriminator(self.G, self.t, update_ema=False)
+        self.sampler = self.sampler(self.z, self.t)
+
+        self.model_variables = tf.global_variables()
+        self.saver = tf.train.Saver(self.model_variables, max_to_keep=50)
+
+
+    def init_unsaved_variables(self):
+        """Initializes the variables the checkpoint does not hold, like
+        those of `build_completion`, after `load`."""
+        saved = set(self.model_variables)
+        self.sess.run(tf.variables_initializer([v for v in tf.global_variables() if v not in saved]))
+
+
+    def contextual_kl(self, G, images):
+        """Per-sample kl divergence between the grayscale sketch halves of
+        `G` and `images`."""
+        return kl_divergence(
+            tf.divide(tf.add(tf.contrib.layers.flatten(tf.image.rgb_to_grayscale(
+                tf.slice(G, [0,0,0,0], [-1,self.image_size,self.image_size,self.c_dim]))), 1), 2),
+            tf.divide(tf.add(tf.contrib.layers.flatten(tf.image.rgb_to_grayscale(
+                tf.slice(images, [0,0,0,0], [-1,self.image_size,self.image_size,self.c_dim]))), 1), 2))
+
+
+    def completion_loss(self, z, t, images, quantize=None):
+        """Generated images and per-sample completion loss of `z`, computed
+        with batch statistics and no moving-average updates. `quantize` as
+        in `generator`.
+
+        The perceptual term is each sample's own rather than the batch
+        mean, with the same gradient of the summed loss. The batch norm
+        statistics still come from the whole batch, so every loss depends
+        on which rows are in it."""
+        G = self.generator(z, t, update_ema=False, quantize=quantize)
+        _, D_logits = self.discriminator(G, t, reuse=True, update_ema=False)
+        perceptual_loss = tf.reduce_mean(
+            tf.nn.sigmoid_cross_entropy_with_logits(D_logits, tf.ones_like(D_logits)), [1, 2, 3])
+        return G, self.lam1*self.contextual_kl(G, images) + self.lam2*perceptual_loss
+
+
+    def build_completion(self, lr, momentum, quantize=None):
+        """In-graph latent optimizer for `test`.
+
+        z, its momentum and the batch's images and attributes live in
+        variables, loaded once per batch from the `z`, `images` and `t`
+        placeholders by `c_load`. Running `c_step` applies `c_steps`
+        Nesterov updates with clipping inside one `tf.while_loop`, freezing
+        samples whose `c_active` entry is 0, and yields the loss and
+        gradient of the last update. `c_G`/`c_loss` evaluate the current z.
+        `c_compact` keeps only the rows `c_keep` of the batch, in that
+        order, so that finished samples stop costing compute.
+
+        The variables take the batch size of whatever `c_load` feeds.
+        `quantize` (see `quantize.int8_weights`) runs the loop on the
+        simulated int8 generator.
+        """
+        def batch_variable(shape, name):
+            v = tf.Variable(tf.zeros([self.batch_size] + shape), trainable=False,
+                            validate_shape=False, name=name)
+            return v, tf.reshape(v.value(), [-1] + shape)
+
+        with tf.name_scope('completion'):
+            self.c_z, z_value = batch_variable([self.z_dim], 'z')
+            self.c_v, v_value = batch_variable([self.z_dim], 'v')
+            self.c_images, images_value = batch_variable(self.image_shape, 'images')
+            self.c_t, t_value = batch_variable([self.text_vector_dim], 't')
+            self.c_load = tf.group(tf.assign(self.c_z, self.z, validate_shape=False),
+                                   tf.assign(self.c_v, tf.zeros_like(self.z), validate_shape=False),
+                                   tf.assign(self.c_images, self.images, validate_shape=False),
+                                   tf.assign(self.c_t, self.t, validate_shape=False))
+            self.c_steps = tf.placeholder(tf.int32, [], name='steps')
+            self.c_active = tf.placeholder(tf.float32, [None], name='active')
+            self.c_keep = tf.placeholder(tf.int32, [None], name='keep')
+            self.c_compact = tf.group(*[tf.assign(var, tf.gather(value, self.c_keep), validate_shape=False)
+                                        for var, value in [(self.c_z, z_value), (self.c_v, v_value),
+                                                           (self.c_images, images_value),
+                                                           (self.c_t, t_value)]])
+
+        def complete_loss(z):
+            return self.completion_loss(z, t_value, images_value, quantize)
+
+        active = tf.expand_dims(self.c_active, 1)
+        def step(i, z, v, loss, g):
+            _, loss = complete_loss(z)
+            g = tf.gradients(loss, z)[0]
+            v_new = (momentum*v - lr*g) * active
+            z = tf.clip_by_value(z + (-momentum*v + (1+momentum)*v_new) * active, -1, 1)
+            return i+1, z, v_new, loss, g
+
+        _, z, v, self.c_last_loss, self.c_last_grad = tf.while_loop(
+            lambda i, z, v, loss, g: i < self.c_steps, step,
+            [tf.constant(0), z_value, v_value, tf.zeros_like(self.c_active), tf.zeros_like(z_value)])
+        with tf.control_dependencies([self.c_last_loss, self.c_last_grad]):
+            self.c_step = tf.group(tf.assign(self.c_z, z, validate_shape=False),
+                                   tf.assign(self.c_v, v, validate_shape=False))
+
+        self.c_G, self.c_loss = complete_loss(z_value)
+
         
     def train(self, config):
-        image_data = glob(os.path.join(config.dataset, "*.png"))
-        #np.random.shuffle(data)
-        print (os.path.join(config.dataset, "*.png"))
+        assert(not self.inference)
+        if config.cache_dir:
+            # decoded uint8 images, no per-epoch glob or png decoding
+            image_cache = ImageCache(config.cache_dir)
+            image_data = image_cache.files
+            print ("using image cache", config.cache_dir)
+        else:
+            image_cache = None
+            image_data = glob(os.path.join(config.dataset, "*.png"))
+            #np.random.shuffle(data)
+            print (os.path.join(config.dataset, "*.png"))
         assert(len(image_data) > 0)
         
-        text_data = pickle.load(open(config.text_path, 'rb'))
+        text_store = self.open_text_store(config)
+        text_rows = text_store.rows(image_data)
         
         ######### for face attributes #########
-        attr_sum = np.sum(text_data, 0)
-        attr_percent = (1 + attr_sum/len(text_data)) / 2
+        attr_percent = (1 + text_store.mean()) / 2
         print ("selected attribute percentages:\n", attr_percent)
         ######### for face attributes #########
         
-        d_optim = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1) \
-                          .minimize(self.d_loss, var_list=self.d_vars)
-        g_optim = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1) \
-                          .minimize(self.g_loss, var_list=self.g_vars)
+        d_opt = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1)
+        g_opt = tf.train.AdamOptimizer(config.learning_rate, beta1=config.beta1)
+        assert(not (config.fused_step and config.num_towers > 1))
+        # d_bn_stats only applies to the fused pass
+        assert(self.fused_discriminator or self.d_bn_stats == 'split')
+        if config.fused_step:
+            train_step, fused_g_loss = self.build_fused_step(d_opt, g_opt)
+        elif config.num_towers > 1:
+            assert(self.batch_size % config.num_towers == 0)
+            d_optim, g_optim, tower_d_fetches, tower_g_loss = self.build_tower_steps(
+                d_opt, g_opt, config.num_towers)
+        else:
+            d_optim = d_opt.minimize(self.d_loss, var_list=self.d_vars)
+            g_optim = g_opt.minimize(self.g_loss, var_list=self.g_vars)
         tf.initialize_all_variables().run()
 
-        self.g_sum = tf.merge_summary(
-            [self.z_sum, self.t_sum, self.d_fk_sum, self.G_sum, self.d_loss_fake_sum, self.g_loss_sum])
-        self.d_sum = tf.merge_summary(
-            [self.z_sum, self.t_sum, self.d_rl_sum, self.d_wr_sum, self.d_loss_real_sum, self.d_loss_wrong_sum, self.d_loss_sum])
+        state_shapes = {'counter': ([], tf.int64), 'epoch': ([], tf.int64), 'idx': ([], tf.int64),
+                        'seed': ([], tf.int64), 'rng_keys': ([624], tf.int64), 'rng_pos': ([2], tf.int64),
+                        'rng_gauss': ([1], tf.float64),
+                        'sample_z': ([self.batch_size, self.z_dim], tf.float32),
+                        'sample_t': ([self.batch_size, self.text_vector_dim], tf.float32)}
+        checkpointer = TrainCheckpointer(self.sess, tf.global_variables(), state_shapes,
+                                         config.checkpoint_dir, self.model_name,
+                                         max_to_keep=config.keep_checkpoints,
+                                         keep_every_hours=config.keep_checkpoint_hours,
+                                         use_thread=config.async_save)
+
+        # losses go through the in-process accumulator, histograms and
+        # images are only evaluated on their own cadence
+        self.hist_sum = tf.merge_summary(
+            [self.z_sum, self.t_sum, self.t_wr_sum, self.d_rl_sum, self.d_fk_sum, self.d_wr_sum])
+        self.image_sum = self.G_sum
         self.writer = tf.train.SummaryWriter(self.log_dir, self.sess.graph)
+        scalars = ScalarAccumulator(self.writer, config.scalar_summary_freq)
+        self.image_writer = AsyncImageWriter(config.writer_threads, config.writer_queue)
+        atexit.register(self.image_writer.close)
+
+        if config.sample_freq > 0:
+            self.sample_freq = config.sample_freq
+        if config.save_freq > 0:
+            self.save_freq = config.save_freq
 
         
         #++++++++ training sample ++++++++#
         
         sample_z = np.random.uniform(-1, 1, size=(self.batch_size , self.z_dim))
         sample_files = image_data[0:self.batch_size]
-        sample = [get_image(sample_file, self.image_size, is_crop=self.is_crop) for sample_file in sample_files]
-        sample_images = np.array(sample).astype(np.float32)
-        sample_t_ = [get_text_batch(os.path.basename(sample_file), text_data) for sample_file in sample_files]
-        sample_t = np.array(sample_t_).astype(np.float32)
+        if image_cache is not None:
+            sample_images = image_cache.get_images(slice(0, self.batch_size))
+        else:
+            sample = [get_image(sample_file, self.image_size, is_crop=self.is_crop) for sample_file in sample_files]
+            sample_images = np.array(sample).astype(np.float32)
+        sample_t = text_store.take(text_rows[0:self.batch_size])
         nRows = np.ceil(self.batch_size/8)
         nCols = min(8, self.batch_size) #8
 
-        ######### for face attributes #########
-        with open(os.path.join(self.sample_dir, 'sampled_texts.txt'), 'wb') as f:
-            np.savetxt(f, sample_t, fmt='%i', delimiter='\t')
-        ######### for face attributes #########
-
         #-------- training sample --------#
 
         counter = 1
+        start_epoch, start_idx = 0, 0
         start_time = time.time()
 
-        if self.load(self.checkpoint_dir):
+        state = checkpointer.restore()
+        if state is not None:
             print("""
 
 ============
@@ -241,100 +426,316 @@ Initializing a new one.
 ============
 
 """)
+        if state:
+            # continue with the batch after the checkpoint
+            counter, start_epoch, start_idx = int(state['counter']), int(state['epoch']), int(state['idx'])
+            sample_z, sample_t = state['sample_z'], state['sample_t']
+            set_rng_state(state)
+            print(" [*] Resuming at step %d, epoch %d, batch %d" % (counter, start_epoch, start_idx))
 
-        for epoch in xrange(config.epoch):
-            image_data = glob(os.path.join(config.dataset, "*.png"))
-            batch_idxs = min(len(image_data), config.train_size) // self.batch_size
+        ######### for face attributes #########
+        if config.rank <= 0:
+            with open(os.path.join(self.sample_dir, 'sampled_texts.txt'), 'wb') as f:
+                np.savetxt(f, sample_t, fmt='%i', delimiter='\t')
+        ######### for face attributes #########
 
-            for idx in xrange(0, batch_idxs):
+        # every process trains on its own shard for the same number of steps
+        batch_idxs = min(len(image_data) // config.num_procs, config.train_size) // self.batch_size
+        if state:
+            seed = int(state['seed'])
+        else:
+            seed = config.seed if config.seed >= 0 else np.random.randint(2**31)
+        # the process seed before the per-rank offset, saved with the checkpoints
+        base_seed = seed
+        if config.num_procs > 1:
+            cache_positions = np.arange(config.rank, len(image_data), config.num_procs)
+            image_data = image_data[config.rank::config.num_procs]
+            text_rows = text_rows[config.rank::config.num_procs]
+            seed += config.rank
+            # the batch norm averages are of tensors, which leaves them out of
+            # tf.moving_average_variables(): list their shadow variables
+            bns = [self.g_bn0, self.g_bn1, self.g_bn2, self.g_bn3, self.d_bn1, self.d_bn2, self.d_bn3]
+            averager = ParameterAverager(self.sess, tf.trainable_variables() +
+                                         [x for bn in bns for x in (bn.ema_mean, bn.ema_var)],
+                                         config.rank, config.num_procs, config.sync_port,
+                                         config.sync_timeout)
+            # start from the weights of rank 0, restored or initialized
+            averager.broadcast()
+        else:
+            cache_positions = None
+            averager = None
+        is_chief = config.rank <= 0
+        negatives = NegativeSampler(config.negative_mode, attr_percent=attr_percent,
+                                    attr_table=text_store.matrix, num_candidates=config.hard_candidates)
+        make_batch = BatchMaker(image_data, text_store, text_rows, negatives, self.batch_size, self.z_dim,
+                                image_size=self.image_size, is_crop=self.is_crop,
+                                cache_dir=config.cache_dir, seed=seed, cache_positions=cache_positions)
+        jobs = ((epoch, idx) for epoch in xrange(start_epoch, config.epoch)
+                for idx in xrange(start_idx if epoch == start_epoch else 0, batch_idxs))
+        if config.num_workers > 0:
+            prefetcher = BatchPrefetcher(make_batch, jobs, num_workers=config.num_workers,
+                                         queue_size=config.prefetch_size,
+                                         use_processes=config.worker_processes)
+        else:
+            prefetcher = None
+
+        # per-phase wall times, see profiling.py
+        timer = PhaseTimer()
+        profile_log = JsonlLog(config.profile_log) if config.profile_log else None
+        tracer = Tracer(parse_steps(config.trace_steps), config.trace_dir)
+
+        for epoch in xrange(start_epoch, config.epoch):
+            for idx in xrange(start_idx if epoch == start_epoch else 0, batch_idxs):
                 
                 #++++++++ data loading ++++++++#
                 
                 data_start_time = time.time()
-                batch_files = image_data[idx*config.batch_size:(idx+1)*config.batch_size]
-                batch = [get_image(batch_file, self.image_size, is_crop=self.is_crop)
-                         for batch_file in batch_files]
-                batch_images = np.array(batch).astype(np.float32)
-
-                batch_z = np.random.uniform(-1, 1, [config.batch_size, self.z_dim]) \
-                            .astype(np.float32)
-
-                batch_t_ = [get_text_batch(os.path.basename(batch_file), text_data)
-                         for batch_file in batch_files]
-                batch_t = np.array(batch_t_).astype(np.float32)
-
-                ######### for face attributes #########
-                # randomly generated wrong face attributes
-                batch_t_wr_ = [np.random.choice(np.arange(2), size=config.batch_size, 
-                                                p=[1-attr_percent[i], attr_percent[i]]) * 2 - 1 
-                               for i in xrange(self.text_vector_dim)]
-                batch_t_wr = np.transpose(batch_t_wr_).astype(np.float32)
-                ######### for face attributes #########
-                
-                '''
-                # randomly select wrong images
-                idx_wr = np.random.randint(batch_idxs)
-                while (idx_wr == idx):
-                    idx_wr = np.random.randint(batch_idxs)
-
-                batch_files_wr = image_data[idx_wr*config.batch_size:(idx_wr+1)*config.batch_size]
-                batch_wr = [get_image(batch_file_wr, self.image_size, is_crop=self.is_crop)
-                         for batch_file_wr in batch_files_wr]
-                batch_images_wr = np.array(batch_wr).astype(np.float32)
-                '''
+                if prefetcher is not None:
+                    _, (batch_images, batch_z, batch_t, batch_t_wr) = prefetcher.get()
+                else:
+                    batch_images, batch_z, batch_t, batch_t_wr = make_batch((epoch, idx))
+
                 data_time = time.time() - data_start_time
+                timer.add('data', data_time)
 
                 #-------- data loading --------#
 
                 
                 #++++++++ training ++++++++#
                 
-                # Update D network
-                _, summary_str = self.sess.run([d_optim, self.d_sum],
-                    feed_dict={ self.images: batch_images, self.z: batch_z, self.t: batch_t, self.t_wr: batch_t_wr })
-                self.writer.add_summary(summary_str, counter)
-
-                # Update G network
-                _, summary_str = self.sess.run([g_optim, self.g_sum],
-                    feed_dict={ self.z: batch_z, self.t: batch_t })
-                self.writer.add_summary(summary_str, counter)
-
-                # Run g_optim twice to make sure that d_loss does not go to zero (different from paper)
-                _, summary_str = self.sess.run([g_optim, self.g_sum],
-                    feed_dict={ self.z: batch_z, self.t: batch_t })
-                self.writer.add_summary(summary_str, counter)
-                
-                errD_fake = self.d_loss_fake.eval({self.z: batch_z, self.t: batch_t})
-                errD_real = self.d_loss_real.eval({self.images: batch_images, self.t: batch_t})
-                errG = self.g_loss.eval({self.z: batch_z, self.t: batch_t})
+                step = counter
+                feed = { self.images: batch_images, self.z: batch_z, self.t: batch_t, self.t_wr: batch_t_wr }
+                g_feed = { self.z: batch_z, self.t: batch_t }
+                summaries = []
+                if config.hist_summary_freq > 0 and (counter - 1) % config.hist_summary_freq == 0:
+                    summaries.append(self.hist_sum)
+                if config.image_summary_freq > 0 and (counter - 1) % config.image_summary_freq == 0:
+                    summaries.append(self.image_sum)
+                d_fetches = [self.d_loss_real, self.d_loss_fake, self.d_loss_wrong, self.d_loss]
+
+                if config.fused_step:
+                    # Update D, then G twice, and fetch the losses in one call
+                    with timer.phase('fused_step'):
+                        _, d_losses, errG, summary_strs = tracer.run(self.sess, step, 'fused_step',
+                            [train_step, d_fetches, fused_g_loss, summaries], feed)
+                    errD_real, errD_fake = d_losses[0], d_losses[1]
+                    errG_step = errG
+                elif config.num_towers > 1:
+                    # Same updates as below, gradients averaged over the towers
+                    with timer.phase('d_step'):
+                        _, d_losses, summary_strs = tracer.run(self.sess, step, 'd_step',
+                            [d_optim, tower_d_fetches, summaries], feed)
+                    with timer.phase('g_step'):
+                        tracer.run(self.sess, step, 'g_step', g_optim, g_feed)
+                        _, errG_step = self.sess.run([g_optim, tower_g_loss], feed_dict=g_feed)
+                    errD_real, errD_fake = d_losses[0], d_losses[1]
+                    errG = errG_step
+                else:
+                    # Update D network
+                    with timer.phase('d_step'):
+                        _, d_losses, summary_strs = tracer.run(self.sess, step, 'd_step',
+                            [d_optim, d_fetches, summaries], feed)
+
+                    with timer.phase('g_step'):
+                        # Update G network
+                        tracer.run(self.sess, step, 'g_step', g_optim, g_feed)
+
+                        # Run g_optim twice to make sure that d_loss does not go to zero (different from paper)
+                        _, errG_step = self.sess.run([g_optim, self.g_loss], feed_dict=g_feed)
+                    
+                    with timer.phase('loss_eval'):
+                        if self.fused_discriminator:
+                            # the fused d losses read every placeholder
+                            errD_fake, errD_real = self.sess.run(
+                                [self.d_loss_fake, self.d_loss_real], feed_dict=feed)
+                            errG = self.g_loss.eval(g_feed)
+                        else:
+                            errD_fake = self.d_loss_fake.eval({self.z: batch_z, self.t: batch_t})
+                            errD_real = self.d_loss_real.eval({self.images: batch_images, self.t: batch_t})
+                            errG = self.g_loss.eval({self.z: batch_z, self.t: batch_t})
+
+                with timer.phase('summaries'):
+                    for summary_str in summary_strs:
+                        self.writer.add_summary(summary_str, counter)
+                    scalars.add({'d_loss_real': d_losses[0], 'd_loss_fake': d_losses[1],
+                                 'd_loss_wrong': d_losses[2], 'd_loss': d_losses[3],
+                                 'g_loss': errG_step}, counter)
+                if averager is not None and np.mod(counter, config.sync_freq) == 0:
+                    with timer.phase('sync'):
+                        averager.average()
                 #-------- training --------#
 
                 counter += 1
                 print("Epoch: [%2d] [%4d/%4d] data_time: %4.4f, time: %4.4f, d_loss: %.8f, g_loss: %.8f" \
                     % (epoch, idx, batch_idxs, data_time,
                         time.time() - start_time, errD_fake+errD_real, errG))
+                if prefetcher is not None and np.mod(counter, 100) == 1:
+                    print("prefetch queue depth: %d (mean %.2f), starved: %4.4f s total, %4.4f s/batch" \
+                        % tuple(prefetcher.stats()[k] for k in ['depth', 'mean_depth', 'wait_time', 'mean_wait']))
                 
-                if np.mod(counter, self.sample_freq) == 1:
-                    samples = self.sess.run(
-                        [self.sampler], feed_dict={self.z: sample_z, self.t: sample_t})
-                    save_images(samples[0], [nRows, nCols],
-                                os.path.join(self.sample_dir, 'train_{:02d}_{:04d}.png'.format(epoch, idx)))
+                if averager is not None and np.mod(counter, 100) == 1:
+                    print("parameter averaging: %4.4f s total" % averager.sync_time)
+
+                if is_chief and np.mod(counter, self.sample_freq) == 1:
+                    with timer.phase('sampling'):
+                        samples = self.sess.run(
+                            [self.sampler], feed_dict={self.z: sample_z, self.t: sample_t})
+                    with timer.phase('image_write'):
+                        self.image_writer.save_images(samples[0], [nRows, nCols],
+                                    os.path.join(self.sample_dir, 'train_{:02d}_{:04d}.png'.format(epoch, idx)))
                     #print("[Sample] d_loss: %.8f, g_loss: %.8f" % (d_loss, g_loss))
 
-                if np.mod(counter, self.save_freq) == 2:
-                    self.save(config.checkpoint_dir, counter)
+                if is_chief and np.mod(counter, self.save_freq) == 2:
+                    with timer.phase('checkpoint'):
+                        # the position of the next batch
+                        next_epoch, next_idx = (epoch, idx+1) if idx+1 < batch_idxs else (epoch+1, 0)
+                        checkpointer.save(counter, dict(rng_state_arrays(), counter=counter,
+                                                        epoch=next_epoch, idx=next_idx, seed=base_seed,
+                                                        sample_z=sample_z, sample_t=sample_t))
+
+                phases = timer.end_step()
+                if profile_log is not None:
+                    profile_log.write(event='step', step=step, epoch=epoch, idx=idx, phases=phases,
+                                      d_loss=float(d_losses[3]), g_loss=float(errG_step))
+                if config.profile_freq > 0 and (counter - 1) % config.profile_freq == 0:
+                    print("phase times (mean of the last %d steps): %s" % (timer.window, timer.summary()))
+                    if profile_log is not None:
+                        profile_log.write(event='stats', step=step, stats=timer.stats())
+
+        scalars.flush(counter)
+        self.writer.flush()
+        self.image_writer.close()
+        if prefetcher is not None:
+            prefetcher.close()
+        if averager is not None:
+            averager.close()
+        checkpointer.close()
+        if profile_log is not None:
+            profile_log.write(event='stats', step=counter-1, stats=timer.stats())
+            profile_log.close()
+
+
+    def open_text_store(self, config):
+        if config.text_store:
+            return EmbeddingStore.open(config.text_store)
+        return EmbeddingStore.from_pickle(config.text_path)
+
+
+    def build_fused_step(self, d_opt, g_opt):
+        """Chains the D update and the two G updates into one op.
+
+        Each G update recomputes G and D(G) under a control dependency on
+        the previous update, so it sees the same weights as the separate
+        `sess.run` calls. The D update minimizes `d_loss` of `build_model`,
+        the fused pass with its batch norm statistics if there is one. The returned g_loss is the one of the last G
+        update, taken before that update is applied; d_loss_real and
+        d_loss_fake can be fetched alongside from the D update's forward pass.
+        """
+        step = d_opt.minimize(self.d_loss, var_list=self.d_vars)
+        for _ in xrange(2):
+            with tf.control_dependencies([step]):
+                G = self.generator(self.z, self.t, update_ema=False)
+                _, D_logits_fk = self.discriminator(G, self.t, reuse=True, update_ema=False)
+                g_loss = tf.reduce_mean(
+                    tf.nn.sigmoid_cross_entropy_with_logits(D_logits_fk,
+                                                            tf.ones_like(D_logits_fk)))
+                step = g_opt.minimize(g_loss, var_list=self.g_vars)
+        return step, g_loss
+
+
+    def build_tower_steps(self, d_opt, g_opt, num_towers):
+        """D and G updates averaging the gradients of `num_towers` copies
+        of the networks, each on an equal slice of the batch.
+
+        The towers use batch statistics only; the moving averages follow
+        the statistics of the first tower, updated together with each
+        step (G's in both, D's in the D step, as in `build_model`). With
+        `fused_discriminator` each tower runs D once over its real, fake
+        and wrong-text slices for the D loss, with `d_bn_stats`, and once
+        more over the fake slice for the G loss.
+        Returns d_optim, g_optim, the tower-averaged
+        [d_loss_real, d_loss_fake, d_loss_wrong, d_loss] and g_loss.
+        """
+        images = tf.split(0, num_towers, self.images)
+        zs = tf.split(0, num_towers, self.z)
+        ts = tf.split(0, num_towers, self.t)
+        t_wrs = tf.split(0, num_towers, self.t_wr)
+        g_bns = [self.g_bn0, self.g_bn1, self.g_bn2, self.g_bn3]
+        d_bns = [self.d_bn1, self.d_bn2, self.d_bn3]
+
+        d_grads, g_grads, d_losses, g_losses = [], [], [], []
+        for i in xrange(num_towers):
+            with tf.name_scope('tower_%d' % i):
+                G = self.generator(zs[i], ts[i], update_ema=False)
+                if i == 0:
+                    g_moments = [bn.batch_moments for bn in g_bns]
+                if self.fused_discriminator:
+                    _, D_logits = self.discriminator(tf.concat(0, [images[i], G, images[i]]),
+                                                     tf.concat(0, [ts[i], ts[i], t_wrs[i]]),
+                                                     reuse=True, update_ema=False,
+                                                     bn_groups=3 if self.d_bn_stats == 'split' else 1)
+                    if i == 0:
+                        d_moments = [bn.batch_moments for bn in d_bns]
+                    D_logits_rl, D_logits_fk, D_logits_wr = tf.split(0, 3, D_logits)
+                    _, G_logits = self.discriminator(G, ts[i], reuse=True, update_ema=False)
+                else:
+                    _, D_logits_rl = self.discriminator(images[i], ts[i], reuse=True, update_ema=False)
+                    if i == 0:
+                        d_moments = [bn.batch_moments for bn in d_bns]
+                    _, D_logits_fk = self.discriminator(G, ts[i], reuse=True, update_ema=False)
+                    _, D_logits_wr = self.discriminator(images[i], t_wrs[i], reuse=True, update_ema=False)
+                    G_logits = D_logits_fk
+
+                g_loss = tf.reduce_mean(
+                    tf.nn.sigmoid_cross_entropy_with_logits(G_logits, tf.ones_like(G_logits)))
+                d_loss_real = tf.reduce_mean(
+                    tf.nn.sigmoid_cross_entropy_with_logits(D_logits_rl, tf.ones_like(D_logits_rl)))
+                d_loss_fake = tf.reduce_mean(
+                    tf.nn.sigmoid_cross_entropy_with_logits(D_logits_fk, tf.zeros_like(D_logits_fk)))
+                d_loss_wrong = tf.reduce_mean(
+                    tf.nn.sigmoid_cross_entropy_with_logits(D_logits_wr, tf.zeros_like(D_logits_wr)))
+                d_loss = d_loss_real + d_loss_fake + self.lam3 * d_loss_wrong
+
+                d_grads.append(d_opt.compute_gradients(d_loss, var_list=self.d_vars))
+                g_grads.append(g_opt.compute_gradients(g_loss, var_list=self.g_vars))
+                d_losses.append([d_loss_real, d_loss_fake, d_loss_wrong, d_loss])
+                g_losses.append(g_loss)
+
+        g_ema = [bn.ema_update(*moments) for bn, moments in zip(g_bns, g_moments)]
+        d_ema = [bn.ema_update(*moments) for bn, moments in zip(d_bns, d_moments)]
+        with tf.control_dependencies(g_ema + d_ema):
+            d_optim = d_opt.apply_gradients(average_gradients(d_grads))
+        with tf.control_dependencies(g_ema):
+            g_optim = g_opt.apply_gradients(average_gradients(g_grads))
+
+        d_fetches = [tf.add_n(list(l)) / num_towers for l in zip(*d_losses)]
+        return d_optim, g_optim, d_fetches, tf.add_n(g_losses) / num_towers
 
 
     def test(self, config):
-        tf.initialize_all_variables().run()
-
+        # restore, then initialize only what the checkpoint does not hold;
+        # the simulated int8 weights are constants of the restored values
         isLoaded = self.load(self.checkpoint_dir)
         assert(isLoaded)
+        self.build_completion(config.lr, config.momentum,
+                              int8_weights(self, load_quant_ranges(config.simulatedInt8))
+                              if config.simulatedInt8 else None)
+        self.init_unsaved_variables()
+        print(" [*] Startup: %.2fs, max resident memory %.1f MB" % (
+            time.time() - config.startTime, max_rss_mb()))
+
+        self.image_writer = AsyncImageWriter(config.writerThreads, config.writerQueue)
+        atexit.register(self.image_writer.close)
+        if config.outFormat == 'store':
+            out = StoreOutput(config.outDir, self.image_writer)
+        else:
+            out = PngOutput(config.outDir, self.image_writer)
+        # finish the pending batch writes on an error or interrupt too
+        atexit.register(out.close)
 
         # image_data = glob(os.path.join(config.dataset, "*.png"))
         nImgs = len(config.imgs)
 
-        batch_idxs = int(np.ceil(nImgs/self.batch_size))
         if config.maskType == 'right':
             mask = np.ones(self.image_shape)
             mask[:,self.image_size:,:] = 0.0
@@ -344,31 +745,39 @@ Initializing a new one.
         else:
             assert(False)
             
-        text_data = pickle.load(open(config.text_path, 'rb'))
+        text_store = self.open_text_store(config)
 
-        num_batch = int(np.ceil(nImgs/self.batch_size))
+        # K latent candidates per image are optimized side by side in the
+        # session batch, slot j holding candidate j % K of image j // K
+        K = config.nRestarts
+        imgs_per_batch = self.batch_size // K
+        assert(imgs_per_batch > 0)
+
+        # per-phase wall times of every batch, see profiling.py
+        timer = PhaseTimer()
+        profile_log = JsonlLog(config.profileLog) if config.profileLog else None
+        tracer = Tracer(config.traceBatches, config.traceDir)
+
+        num_batch = int(np.ceil(nImgs/imgs_per_batch))
         for idx in xrange(0, num_batch):
             print('batch no. ' + str(idx+1) + ':\n')
             
-            l = idx*self.batch_size
-            u = min((idx+1)*self.batch_size, nImgs)
+            data_start_time = time.time()
+            l = idx*imgs_per_batch
+            u = min((idx+1)*imgs_per_batch, nImgs)
             batchSz = u-l
+            nSlots = batchSz*K
             batch_files = config.imgs[l:u]
             batch = [get_image(batch_file, self.image_size, is_crop=self.is_crop)
                      for batch_file in batch_files]
             batch_images = np.array(batch).astype(np.float32)
-            batch_mask = np.resize(mask, [self.batch_size] + self.image_shape)
-            
-            os.makedirs(os.path.join(config.outDir, 'hats_imgs_{:04d}'.format(idx)))
-            os.makedirs(os.path.join(config.outDir, 'completed_{:04d}'.format(idx)))
+            batch_mask = np.resize(mask, [nSlots] + self.image_shape)
             
             #++++++++ for face attributes ++++++++#
             
             # attributes to be loaded
             if (config.attributes[0] == None):
-                batch_t_ = [get_text_batch(os.path.basename(batch_file), text_data)
-                        for batch_file in batch_files]
-                batch_t = np.array(batch_t_).astype(np.float32)
+                batch_t = text_store.take(text_store.rows(batch_files))
                 
             # user_defiened attributes
             else:
@@ -377,125 +786,162 @@ Initializing a new one.
                 print('using attributes: ', attr_v)
                 batch_t = np.array([attr_v,]*batchSz).astype(np.float32)
                 
-            with open(os.path.join(config.outDir, 'completed_{:04d}/texts.txt'.format(idx)), 'wb') as f:
-                np.savetxt(f, batch_t, fmt='%i', delimiter='\t')
+            out.begin_batch(idx, batch_files, batch_t, mask)
                 
             #-------- for face attributes --------#
             
-            # last batch
-            if batchSz < self.batch_size:
-                print(batchSz)
-                padSz = ((0, int(self.batch_size-batchSz)), (0,0), (0,0), (0,0))
-                batch_images = np.pad(batch_images, padSz, 'wrap')
-                batch_images = batch_images.astype(np.float32)
-                batch_t = np.pad(batch_t, ((0, int(self.batch_size-batchSz)), (0,0)), 'wrap')
-            
-            
-            nRows = np.ceil(batchSz/8)
-            nCols = min(8, batchSz) #8
+            # the last batch is run at its own size, it is not padded
+            if K > 1:
+                batch_images = np.repeat(batch_images, K, axis=0)
+                batch_t = np.repeat(batch_t, K, axis=0)
+            timer.add('data', time.time() - data_start_time)
             
             
             #++++++++ z initialization ++++++++#
             
-            zhats_init = np.random.uniform(-1, 1, size=(self.batch_size, self.z_dim)).astype(np.float32)
-            zhats_ = zhats_init.copy()
-            kl_div = np.full(len(zhats_), np.inf)
-            in_flat = [rgb2gray(img[:,:self.image_size,:]).flatten() for img in batch_images]
-            in_flat = np.array(in_flat) + 1
-            kld_avg = 0
-            
-            kld_f = open(os.path.join(config.outDir, 'hats_imgs_{:04d}/kld_init.txt'.format(idx)), 'w')
-            kld_f.write('average kl divergence of initializations:')
-            for i in xrange(30):
-                G_imgs = self.sess.run([self.G], feed_dict={ self.z: zhats_, self.t: batch_t })
-                save_images(G_imgs[0][:batchSz,:,:,:], [nRows, nCols],
-                        os.path.join(config.outDir, 'hats_imgs_{:04d}/init_{:02d}.png'.format(idx, i)))
-                
-                out_flat = [rgb2gray(img[:,:self.image_size,:]).flatten() for img in G_imgs[0]]
-                out_flat = np.array(out_flat) + 1
-                
-                # choose lowest kl divergence
-                for j in xrange(self.batch_size):
-                    kl_d = entropy(in_flat[j], out_flat[j])
-                    if (kl_d < kl_div[j]):
-                        zhats_init[j] = zhats_[j]
-                        kl_div[j] = kl_d
-                
-                kld_avg = kl_div.mean()
-                print('average KL divergence:', kld_avg)
-                kld_f.write('{:02d}: {:04.4f}'.format(i, kld_avg))
-                
-                zhats_ = np.random.uniform(-1, 1, size=(self.batch_size, self.z_dim)).astype(np.float32)
+            # all rounds' z are drawn at once, every round is scored with one
+            # vectorized kl divergence over the batch and each slot keeps the
+            # z of its lowest-divergence round
+            kl_start_time = time.time()
+            nRounds = config.initRounds
+            zhats_all = np.random.uniform(-1, 1, size=(nRounds, nSlots, self.z_dim)).astype(np.float32)
+            in_flat = rgb2gray(batch_images[:,:,:self.image_size,:]).reshape(nSlots, -1) + 1
+            kl_all = np.empty((nRounds, nSlots))
+            for i in xrange(nRounds):
+                G_imgs = tracer.run(self.sess, idx, 'kl_init', self.G, { self.z: zhats_all[i], self.t: batch_t })
+                out_flat = rgb2gray(G_imgs[:,:,:self.image_size,:]).reshape(nSlots, -1) + 1
+                kl_all[i] = kl_divergence_rows(in_flat, out_flat)
+                if config.saveInitImgs:
+                    out.images('init', G_imgs[best_slots(kl_all[i], batchSz, K)], step=i)
             
+            # choose lowest kl divergence
+            best_round = np.argmin(kl_all, 0)
+            zhats_init = zhats_all[best_round, np.arange(nSlots)]
+            kl_div = kl_all[best_round, np.arange(nSlots)]
+            kl_run = np.minimum.accumulate(kl_all, 0)
+            kld_avg = kl_div[best_slots(kl_div, batchSz, K)].mean()
             print('choosing min KL divergence:', kld_avg)
-            kld_f.write('choosing min KL divergence: {:04.4f}'.format(kld_avg))
-            kld_f.close()
+            out.kl_init([kl_run[i][best_slots(kl_run[i], batchSz, K)].mean() for i in xrange(nRounds)], kld_avg)
             
             G_imgs = self.sess.run([self.G], feed_dict={ self.z: zhats_init, self.t: batch_t })
-            save_images(G_imgs[0][:batchSz,:,:,:], [nRows, nCols],
-                        os.path.join(config.outDir, 'hats_imgs_{:04d}/chosen_init.png'.format(idx)))
+            out.images('chosen_init', G_imgs[0][best_slots(kl_div, batchSz, K)])
+            timer.add('kl_init', time.time() - kl_start_time)
             
             #-------- z initialization --------#
             
             
             #++++++++ completion ++++++++#
             
-            zhats = zhats_init.copy().astype(np.float32)
-            v = 0
-
-            save_images(batch_images[:batchSz,:,:,:], [nRows,nCols],
-                        os.path.join(config.outDir, 'hats_imgs_{:04d}/gt.png'.format(idx)))
-            masked_images = np.multiply(batch_images, batch_mask)
-            save_images(masked_images[:batchSz,:,:,:], [nRows,nCols],
-                        os.path.join(config.outDir, 'hats_imgs_{:04d}/masked.png'.format(idx)))
+            # converged slots are dropped from the session batch, session
+            # row r holds slot rows[r]; the outputs of the dropped slots are
+            # kept in zhats, loss and G_imgs. The remaining rows then see the
+            # batch norm statistics of a smaller batch, so the logged losses
+            # mix batches; the final ones are evaluated in the full batch
+            tracker = ConvergenceTracker(nSlots, tol=config.convTol, grad_tol=config.gradTol,
+                                         patience=config.patience, max_iters=config.nIter)
+            rows = np.arange(nSlots)
+            zhats = np.copy(zhats_init)
+            loss = np.zeros(nSlots, dtype=np.float32)
+            G_imgs = np.zeros([nSlots] + self.image_shape, dtype=np.float32)
+
+            with timer.phase('output'):
+                out.images('gt', batch_images[::K,:,:,:])
+                masked_images = np.multiply(batch_images, batch_mask)
+                out.images('masked', masked_images[::K,:,:,:])
             
-            for i in xrange(config.nIter):
-                fd = {
-                    self.z: zhats,
-                    self.mask: batch_mask,
-                    self.images: batch_images,
-                    self.t: batch_t,
-                }
-                run = [self.complete_loss, self.grad_complete_loss, self.G]
-                loss, g, G_imgs = self.sess.run(run, feed_dict=fd)
-
-                # update zhats
-                v_prev = np.copy(v)
-                v = config.momentum*v - config.lr*g[0]
-                zhats += -config.momentum * v_prev + (1+config.momentum)*v
-                zhats = np.clip(zhats, -1, 1)
-
+            self.sess.run(self.c_load, feed_dict={
+                self.z: zhats_init, self.images: batch_images, self.t: batch_t })
+            i = 0
+            while i < config.nIter and not tracker.done():
                 # save images
                 if i % 20 == 0:
-                    print(i, np.mean(loss[0:batchSz]))
-                    imgName = os.path.join(config.outDir,
-                                           'hats_imgs_{:04d}/{:04d}.png'.format(idx, i))
-                    save_images(G_imgs[:batchSz,:,:,:], [nRows,nCols], imgName)
-
-                    inv_masked_hat_images = np.multiply(G_imgs, 1.0-batch_mask)
-                    completed = masked_images + inv_masked_hat_images
-                    imgName = os.path.join(config.outDir,
-                                           'completed_{:04d}/{:04d}.png'.format(idx, i))
-                    save_images(completed[:batchSz,:,:,:], [nRows,nCols], imgName)
+                    with timer.phase('snapshot'):
+                        loss[rows], G_imgs[rows] = self.sess.run([self.c_loss, self.c_G])
+                        best = best_slots(loss, batchSz, K)
+                        print(i, np.mean(loss[best]), 'active: %d/%d' % (tracker.active.sum(), nSlots))
+                        out.losses(i, loss[best])
+                        out.images('hats', G_imgs[best], step=i)
+
+                        inv_masked_hat_images = np.multiply(G_imgs, 1.0-batch_mask)
+                        completed = masked_images + inv_masked_hat_images
+                        out.images('completed', completed[best], step=i)
+
+                # run up to the next logging iteration in as few calls as allowed
+                with timer.phase('completion'):
+                    steps = min(config.stepsPerRun, 20 - i % 20, config.nIter - i)
+                    last_loss, g, _ = tracer.run(self.sess, idx, 'completion',
+                        [self.c_last_loss, self.c_last_grad, self.c_step],
+                        { self.c_steps: steps, self.c_active: tracker.active[rows].astype(np.float32) })
+                    stopped = tracker.update(last_loss, g, steps=steps, rows=rows)
+                i += steps
+
+                if stopped.any() and not tracker.done():
+                    with timer.phase('compact'):
+                        done = rows[stopped]
+                        z_rows, loss_rows, G_rows = self.sess.run([self.c_z, self.c_loss, self.c_G])
+                        zhats[done], loss[done], G_imgs[done] = \
+                            z_rows[stopped], loss_rows[stopped], G_rows[stopped]
+                        rows = rows[~stopped]
+                        self.sess.run(self.c_compact, feed_dict={ self.c_keep: np.flatnonzero(~stopped) })
+
+            # samples stopped by the iteration cap did not converge
+            if (tracker.stop_iter >= 0).all() and (tracker.stop_iter < config.nIter).all():
+                print('all samples converged after %d iterations' % i)
+            with timer.phase('output'):
+                zhats[rows] = self.sess.run(self.c_z)
+                # the batch norm statistics depend on the rows in the batch:
+                # evaluate every slot's final z once in the full batch, so
+                # that all candidates are scored alike
+                self.sess.run(self.c_load, feed_dict={
+                    self.z: zhats, self.images: batch_images, self.t: batch_t })
+                loss, G_imgs = self.sess.run([self.c_loss, self.c_G])
+
+                # keep the candidate with the lowest final loss for every image
+                best = best_slots(loss, batchSz, K)
+                print('final', np.mean(loss[best]))
+                out.images('final', G_imgs[best])
+                completed = masked_images + np.multiply(G_imgs, 1.0-batch_mask)
+                out.images('completed_final', completed[best])
+                out.result(zhats_init[best], zhats[best], loss[best], best % K if K > 1 else None)
                     
             #-------- completion --------#
 
 
             #++++++++ interpolation visualization ++++++++#
             
+            interp_start_time = time.time()
             zhats_final = np.copy(zhats)
             diff = zhats_final - zhats_init
             step = 5
             for i in xrange(step):
                 z_ = zhats_init + diff / (step-1) * i
                 G_imgs = self.sess.run([self.G], feed_dict={ self.z: z_, self.t: batch_t })
-                imgName = os.path.join(config.outDir, 'hats_imgs_{:04d}/{:01d}_interp.png'.format(idx, i))
-                save_images(G_imgs[0][:batchSz,:,:,:], [nRows,nCols], imgName)
+                out.images('interp', G_imgs[0][best], step=i)
+            timer.add('interpolation', time.time() - interp_start_time)
                 
             #-------- interpolation visualization --------#
-                
+
+            with timer.phase('output'):
+                out.end_batch()
+
+            phases = timer.end_step()
+            print('phase times: ' + ', '.join('%s %.4f' % p for p in phases.items()))
+            if profile_log is not None:
+                profile_log.write(event='batch', batch=idx, images=batchSz, iterations=int(tracker.iters.max()),
+                                  final_loss=float(np.mean(loss[best])), phases=phases)
+
+        with timer.phase('image_write'):
+            out.close()
+            self.image_writer.close()
+        timer.end_step()
+        if profile_log is not None:
+            profile_log.write(event='stats', batches=num_batch, stats=timer.stats())
+            profile_log.close()
+
                     
-    def discriminator(self, image, t, reuse=False):
+    def discriminator(self, image, t, reuse=False, update_ema=True, bn_groups=1):
+        """`bn_groups` equal slices of the batch get their own batch norm
+        statistics, see `ops.batch_norm`."""
         if reuse:
             tf.get_variable_scope().reuse_variables()
 
@@ -506,9 +952,12 @@ Initializing a new one.
         t_tiled = tf.tile(t_, [1,32,64,1], name='tiled_t')
         h0_concat = tf.concat(3, [h0, t_tiled], name='h0_concat')
         
-        h1 = lrelu(self.d_bn1(conv2d(h0_concat, self.df_dim*2, name='d_h1_conv')))
-        h2 = lrelu(self.d_bn2(conv2d(h1, self.df_dim*4, name='d_h2_conv')))
-        h3 = lrelu(self.d_bn3(conv2d(h2, self.df_dim*8, name='d_h3_conv')))
+        h1 = lrelu(self.d_bn1(conv2d(h0_concat, self.df_dim*2, name='d_h1_conv'),
+                              update_ema=update_ema, groups=bn_groups))
+        h2 = lrelu(self.d_bn2(conv2d(h1, self.df_dim*4, name='d_h2_conv'),
+                              update_ema=update_ema, groups=bn_groups))
+        h3 = lrelu(self.d_bn3(conv2d(h2, self.df_dim*8, name='d_h3_conv'),
+                              update_ema=update_ema, groups=bn_groups))
 
         #h4 = linear(tf.reshape(h3, [-1, 8192*2]), 1, 'd_h3_lin')
         # conv to 512x1x1
@@ -517,7 +966,12 @@ Initializing a new one.
         return tf.nn.sigmoid(h4), h4
 
     
-    def generator(self, z, t):
+    def generator(self, z, t, update_ema=True, quantize=None):
+        """`quantize` maps deconv layer names (g_h0..g_h4) to the calibrated
+        range of their inputs and their int8-rounded filter (lo, hi, w),
+        see `ops.conv2d_transpose`; the
+        inputs of the last call are kept in `deconv_inputs`."""
+        quantize = quantize or {}
         
         self.z_, self.h0_lin_w, self.h0_lin_b = linear(z, self.gf_dim*4*8, 'g_h0_lin', with_w=True)
         z_ = tf.reshape(self.z_, [-1, 4, 8, self.gf_dim])
@@ -528,23 +982,24 @@ Initializing a new one.
         h0_concat = tf.concat(3, [z_, t_tiled])
         
         self.h0, self.h0_w, self.h0_b = conv2d_transpose(h0_concat,
-            [self.batch_size, 4, 8, self.gf_dim*8], 1, 1, 1, 1, name='g_h0', with_w=True)
-        h0 = tf.nn.relu(self.g_bn0(self.h0))
+            [None, 4, 8, self.gf_dim*8], 1, 1, 1, 1, name='g_h0', with_w=True, quantize=quantize.get('g_h0'))
+        h0 = tf.nn.relu(self.g_bn0(self.h0, update_ema=update_ema))
         
         self.h1, self.h1_w, self.h1_b = conv2d_transpose(h0,
-            [self.batch_size, 8, 16, self.gf_dim*4], name='g_h1', with_w=True)
-        h1 = tf.nn.relu(self.g_bn1(self.h1))
+            [None, 8, 16, self.gf_dim*4], name='g_h1', with_w=True, quantize=quantize.get('g_h1'))
+        h1 = tf.nn.relu(self.g_bn1(self.h1, update_ema=update_ema))
 
         h2, self.h2_w, self.h2_b = conv2d_transpose(h1,
-            [self.batch_size, 16, 32, self.gf_dim*2], name='g_h2', with_w=True)
-        h2 = tf.nn.relu(self.g_bn2(h2))
+            [None, 16, 32, self.gf_dim*2], name='g_h2', with_w=True, quantize=quantize.get('g_h2'))
+        h2 = tf.nn.relu(self.g_bn2(h2, update_ema=update_ema))
 
         h3, self.h3_w, self.h3_b = conv2d_transpose(h2,
-            [self.batch_size, 32, 64, self.gf_dim*1], name='g_h3', with_w=True)
-        h3 = tf.nn.relu(self.g_bn3(h3))
+            [None, 32, 64, self.gf_dim*1], name='g_h3', with_w=True, quantize=quantize.get('g_h3'))
+        h3 = tf.nn.relu(self.g_bn3(h3, update_ema=update_ema))
 
         h4, self.h4_w, self.h4_b = conv2d_transpose(h3,
-            [self.batch_size, 64, 128, 3], name='g_h4', with_w=True)
+            [None, 64, 128, 3], name='g_h4', with_w=True, quantize=quantize.get('g_h4'))
+        self.deconv_inputs = [h0_concat, h0, h1, h2, h3]
 
         return tf.nn.tanh(h4)
 
@@ -560,23 +1015,86 @@ Initializing a new one.
         h0_concat = tf.concat(3, [z_, t_tiled])
         
         h0 = conv2d_transpose(h0_concat, 
-            [self.batch_size, 4, 8, self.gf_dim*8], 1, 1, 1, 1, name='g_h0')
+            [None, 4, 8, self.gf_dim*8], 1, 1, 1, 1, name='g_h0')
         h0 = tf.nn.relu(self.g_bn0(h0, train=False))
 
-        h1 = conv2d_transpose(h0, [self.batch_size, 8, 16, self.gf_dim*4], name='g_h1')
+        h1 = conv2d_transpose(h0, [None, 8, 16, self.gf_dim*4], name='g_h1')
         h1 = tf.nn.relu(self.g_bn1(h1, train=False))
 
-        h2 = conv2d_transpose(h1, [self.batch_size, 16, 32, self.gf_dim*2], name='g_h2')
+        h2 = conv2d_transpose(h1, [None, 16, 32, self.gf_dim*2], name='g_h2')
         h2 = tf.nn.relu(self.g_bn2(h2, train=False))
 
-        h3 = conv2d_transpose(h2, [self.batch_size, 32, 64, self.gf_dim*1], name='g_h3')
+        h3 = conv2d_transpose(h2, [None, 32, 64, self.gf_dim*1], name='g_h3')
         h3 = tf.nn.relu(self.g_bn3(h3, train=False))
 
-        h4 = conv2d_transpose(h3, [self.batch_size, 64, 128, 3], name='g_h4')
+        h4 = conv2d_transpose(h3, [None, 64, 128, 3], name='g_h4')
 
         return tf.nn.tanh(h4)
 
 
+    def folded_generator_weights(self):
+        """Current generator weights with every g_bn folded into the deconv
+        before it: the g_h0_lin matrix and bias, then the (filter, biases)
+        pair of each of g_h0..g_h4, as numpy arrays."""
+        variables = dict((v.op.name, v) for v in tf.global_variables())
+        names = ['g_h0_lin/Matrix', 'g_h0_lin/bias'] + ['g_h%d/%s' % (i, n) for i in xrange(5)
+                                                        for n in ('w', 'biases')]
+        bns = [self.g_bn0, self.g_bn1, self.g_bn2, self.g_bn3]
+        values = self.sess.run([variables[n] for n in names] +
+                               [x for bn in bns for x in (bn.ema_mean, bn.ema_var, bn.beta, bn.gamma)])
+        layers, stats = values[2:12], values[12:]
+
+        deconvs = []
+        for i in xrange(5):
+            w, biases = layers[2*i], layers[2*i+1]
+            if i < len(bns):
+                w, biases = fold_batch_norm(w, biases, *stats[4*i:4*i+4], epsilon=bns[i].epsilon)
+            deconvs.append((w, biases))
+        return values[0], values[1], deconvs
+
+
+    def build_folded_sampler(self, z=None, t=None):
+        """Inference generator with every g_bn folded into the deconv
+        before it, so each layer is a single deconv + bias + relu.
+
+        The folded weights are constants taken from the current variable
+        values: call it after `load`, and again if the weights change.
+        """
+        z = self.z if z is None else z
+        t = self.t if t is None else t
+        lin_w, lin_b, deconvs = self.folded_generator_weights()
+
+        with tf.name_scope('folded_sampler'):
+            z_ = tf.reshape(tf.matmul(z, lin_w) + lin_b, [-1, 4, 8, self.gf_dim])
+
+            t_ = tf.expand_dims(tf.expand_dims(t, 1), 2)
+            t_tiled = tf.tile(t_, [1,4,8,1])
+
+            h = tf.concat(3, [z_, t_tiled])
+            shapes = [[None, 4, 8, self.gf_dim*8], [None, 8, 16, self.gf_dim*4],
+                      [None, 16, 32, self.gf_dim*2], [None, 32, 64, self.gf_dim*1], [None, 64, 128, 3]]
+            for i, (shape, (w, biases)) in enumerate(zip(shapes, deconvs)):
+                stride = 1 if i == 0 else 2
+                h = tf.nn.bias_add(deconv2d(h, w, shape, stride, stride), biases)
+                h = tf.nn.relu(h) if i < 4 else tf.nn.tanh(h)
+
+        self.folded_sampler = h
+        return h
+
+
+    def check_folded_sampler(self, n=16, atol=1e-4):
+        """Largest difference between `folded_sampler` and `sampler` on `n`
+        random inputs; raises if it exceeds `atol`."""
+        feed = {self.z: np.random.uniform(-1, 1, [n, self.z_dim]).astype(np.float32),
+                self.t: np.sign(np.random.uniform(-1, 1, [n, self.text_vector_dim])).astype(np.float32)}
+        samples, folded = self.sess.run([self.sampler, self.folded_sampler], feed_dict=feed)
+        err = np.max(np.abs(samples - folded))
+        print(" [*] folded sampler max abs difference: %g" % err)
+        if err > atol:
+            raise ValueError("folded sampler differs from the sampler by %g > %g" % (err, atol))
+        return err
+
+
     def save(self, checkpoint_dir, step):
         if not os.path.exists(checkpoint_dir):
             os.makedirs(checkpoint_dir)
@@ -0,0 +1,51 @@
+"""
+Mismatched ("wrong") attribute vectors for the discriminator.
+"""
+from __future__ import division
+import numpy as np
+
+
+class NegativeSampler(object):
+    """Draws a wrong attribute vector for every row of a batch `t` of +-1
+    attribute vectors, with whole-batch numpy operations.
+
+    Modes:
+        marginal: every attribute is +1 independently with its frequency
+                  `attr_percent` in the dataset.
+        shuffle:  the attributes of another image of the same batch, i.e.
+                  mismatched (image, text) pairs without loading any image.
+        hard:     out of `num_candidates` random rows of `attr_table`, the
+                  one closest in Hamming distance without being identical.
+    """
+    MODES = ('marginal', 'shuffle', 'hard')
+
+    def __init__(self, mode='marginal', attr_percent=None, attr_table=None, num_candidates=16):
+        if mode not in self.MODES:
+            raise ValueError("unknown negative sampling mode '%s', expected one of %s"
+                             % (mode, ', '.join(self.MODES)))
+        if mode == 'marginal' and attr_percent is None:
+            raise ValueError("marginal negative sampling needs attr_percent")
+        if mode == 'hard' and attr_table is None:
+            raise ValueError("hard negative sampling needs attr_table")
+        self.mode = mode
+        self.attr_percent = None if attr_percent is None else np.asarray(attr_percent)
+        self.attr_table = None if attr_table is None else np.asarray(attr_table)
+        self.num_candidates = num_candidates
+
+    def __call__(self, t, rng=np.random):
+        t = np.asarray(t)
+        if self.mode == 'marginal':
+            t_wr = (rng.random_sample(t.shape) < self.attr_percent) * 2 - 1
+        elif self.mode == 'shuffle':
+            # random cyclic permutation, no row keeps its own attributes
+            order = rng.permutation(len(t))
+            src = np.empty(len(t), dtype=np.int64)
+            src[order] = np.roll(order, -1)
+            t_wr = t[src]
+        else:
+            idx = rng.randint(len(self.attr_table), size=(len(t), self.num_candidates))
+            candidates = self.attr_table[idx]
+            dist = np.sum(candidates != t[:, None], axis=2)
+            dist[dist == 0] = t.shape[1] + 1
+            t_wr = candidates[np.arange(len(t)), np.argmin(dist, axis=1)]
+        return t_wr.astype(np.float32)
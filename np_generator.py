@@ -0,0 +1,135 @@
+"""
+Pure-NumPy generator runtime.
+
+Runs the sampler (linear -> reshape -> tiled text concat -> 5 transposed
+convs with batch norm folded in -> tanh) without TensorFlow, from weights
+exported once from a checkpoint:
+
+    python np_generator.py --checkpointDir checkpoints_face_pretrained --text_vector_dim 18 \
+        --outPath generator.npz --check
+
+Every transposed convolution is one GEMM of the input pixels against the
+filter, giving each pixel's k x k output patch, followed by a col2im
+scatter-add of the patches into the strided output.
+"""
+from __future__ import division
+from __future__ import print_function
+import os
+import time
+import argparse
+import numpy as np
+from six.moves import xrange
+
+from weights_io import WeightFile
+
+
+def deconv_output_crop(in_size, out_size, k, stride):
+    """Offset of the `out_size` window in the full transposed-conv output
+    of `in_size` inputs, matching tensorflow's 'SAME' padding."""
+    return max((in_size - 1)*stride + k - out_size, 0) // 2
+
+
+def conv2d_transpose(x, w, biases, stride):
+    """Transposed convolution of x [N, H, W, in] by filter w [k, k, out, in]
+    with 'SAME' padding, output [N, H*stride, W*stride, out]."""
+    n, h, wd, c_in = x.shape
+    k_h, k_w, c_out = w.shape[:3]
+    out_h, out_w = h*stride, wd*stride
+
+    # GEMM: every input pixel to its k_h x k_w x out output patch
+    cols = np.dot(x.reshape(-1, c_in), w.reshape(-1, c_in).T)
+    cols = cols.reshape(n, h, wd, k_h, k_w, c_out)
+
+    # col2im: add the patches into the full output, then crop it
+    full = np.zeros((n, (h-1)*stride + k_h, (wd-1)*stride + k_w, c_out), dtype=x.dtype)
+    for a in xrange(k_h):
+        for b in xrange(k_w):
+            full[:, a:a+(h-1)*stride+1:stride, b:b+(wd-1)*stride+1:stride] += cols[:, :, :, a, b]
+    top = deconv_output_crop(h, out_h, k_h, stride)
+    left = deconv_output_crop(wd, out_w, k_w, stride)
+    out = full[:, top:top+out_h, left:left+out_w]
+    return out + biases
+
+
+def save_generator(path, lin_w, lin_b, deconvs, gf_dim=64):
+    """Writes the folded weights of `GAN.folded_generator_weights`."""
+    arrays = {'lin_w': lin_w, 'lin_b': lin_b, 'gf_dim': np.int64(gf_dim)}
+    for i, (w, biases) in enumerate(deconvs):
+        arrays['h%d_w' % i] = w
+        arrays['h%d_b' % i] = biases
+    np.savez(path, **arrays)
+
+
+class NumpyGenerator(object):
+    """The generator of `GAN.sampler` on numpy arrays, batch norm folded."""
+    def __init__(self, lin_w, lin_b, deconvs, gf_dim=64):
+        self.lin_w = np.asarray(lin_w, dtype=np.float32)
+        self.lin_b = np.asarray(lin_b, dtype=np.float32)
+        self.deconvs = [(np.asarray(w, dtype=np.float32), np.asarray(b, dtype=np.float32))
+                        for w, b in deconvs]
+        self.gf_dim = gf_dim
+        self.z_dim = self.lin_w.shape[0]
+        self.text_vector_dim = self.deconvs[0][0].shape[3] - gf_dim
+
+    @classmethod
+    def load(cls, path):
+        """From a `save_generator` .npz or a `weights_io` weight file."""
+        if not path.endswith('.npz'):
+            weights = WeightFile(path)
+            return cls(*weights.folded_generator_weights(), gf_dim=weights.header['gf_dim'])
+        f = np.load(path)
+        deconvs = [(f['h%d_w' % i], f['h%d_b' % i]) for i in xrange(5)]
+        return cls(f['lin_w'], f['lin_b'], deconvs, int(f['gf_dim']))
+
+    def __call__(self, z, t):
+        z = np.asarray(z, dtype=np.float32)
+        t = np.asarray(t, dtype=np.float32)
+        n = len(z)
+        z_ = (np.dot(z, self.lin_w) + self.lin_b).reshape(n, 4, 8, self.gf_dim)
+        t_tiled = np.broadcast_to(t[:, None, None, :], (n, 4, 8, t.shape[1]))
+        h = np.concatenate([z_, t_tiled], 3)
+        for i, (w, biases) in enumerate(self.deconvs):
+            h = conv2d_transpose(h, w, biases, 1 if i == 0 else 2)
+            h = np.maximum(h, 0) if i < len(self.deconvs) - 1 else np.tanh(h)
+        return h
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--imgSize', type=int, default=64)
+    parser.add_argument('--text_vector_dim', type=int, default=100)
+    parser.add_argument('--checkpointDir', type=str, default='checkpoint')
+    parser.add_argument('--outPath', type=str, default='generator.npz')
+    parser.add_argument('--check', action='store_true') # compare with GAN.sampler on random inputs
+    parser.add_argument('--tol', type=float, default=1e-4) # largest accepted difference from the sampler
+    args = parser.parse_args()
+
+    assert(os.path.exists(args.checkpointDir))
+
+    import tensorflow as tf
+    from model import GAN
+
+    with tf.Session() as sess:
+        model = GAN(sess,
+                    image_size=args.imgSize,
+                    text_vector_dim=args.text_vector_dim,
+                    checkpoint_dir=args.checkpointDir,
+                    inference=True,
+                   )
+        isLoaded = model.load(args.checkpointDir)
+        assert(isLoaded)
+        lin_w, lin_b, deconvs = model.folded_generator_weights()
+        save_generator(args.outPath, lin_w, lin_b, deconvs, model.gf_dim)
+        print(" [*] Saved numpy generator weights to %s" % args.outPath)
+
+        if args.check:
+            generator = NumpyGenerator.load(args.outPath)
+            z = np.random.uniform(-1, 1, [16, model.z_dim]).astype(np.float32)
+            t = np.sign(np.random.uniform(-1, 1, [16, model.text_vector_dim])).astype(np.float32)
+            samples = sess.run(model.sampler, feed_dict={ model.z: z, model.t: t })
+            start_time = time.time()
+            images = generator(z, t)
+            err = np.max(np.abs(samples - images))
+            print(" [*] numpy generator: %.3fs for %d images, max abs difference %g"
+                  % (time.time() - start_time, len(z), err))
+            assert(err <= args.tol)
@@ -22,7 +22,10 @@ class batch_norm(object):
             self.ema = tf.train.ExponentialMovingAverage(decay=self.momentum)
             self.name = name
 
-    def __call__(self, x, train=True):
+    def __call__(self, x, train=True, update_ema=True, groups=1):
+        """With `groups` > 1 the batch is made of that many equal slices,
+        each normalized with its own statistics (the moving averages
+        follow the statistics of the whole batch)."""
         shape = x.get_shape().as_list()
 
         if train:
@@ -33,12 +36,29 @@ class batch_norm(object):
                                     initializer=tf.random_normal_initializer(1., 0.02))
 
                 batch_mean, batch_var = tf.nn.moments(x, [0, 1, 2], name='moments')
-                with tf.variable_scope(tf.get_variable_scope(), reuse=False):
-                    ema_apply_op = self.ema.apply([batch_mean, batch_var])
-                    self.ema_mean, self.ema_var = self.ema.average(batch_mean), self.ema.average(batch_var)
-
-                with tf.control_dependencies([ema_apply_op]):
-                    mean, var = tf.identity(batch_mean), tf.identity(batch_var)
+                self.batch_moments = (batch_mean, batch_var)
+                if update_ema:
+                    with tf.variable_scope(tf.get_variable_scope(), reuse=False):
+                        ema_apply_op = self.ema.apply([batch_mean, batch_var])
+                        self.ema_mean, self.ema_var = self.ema.average(batch_mean), self.ema.average(batch_var)
+
+                    with tf.control_dependencies([ema_apply_op]):
+                        mean, var = tf.identity(batch_mean), tf.identity(batch_var)
+                else:
+                    # batch statistics only, the moving averages are left alone
+                    mean, var = batch_mean, batch_var
+
+                if groups > 1:
+                    x_groups = tf.reshape(x, tf.concat(0, [[groups, -1], tf.shape(x)[1:]]))
+                    group_mean, group_var = tf.nn.moments(x_groups, [1, 2, 3], keep_dims=True,
+                                                          name='group_moments')
+                    # runs the moving average update, if any, like `mean` below
+                    with tf.control_dependencies([mean, var] if update_ema else []):
+                        normed = (x_groups - group_mean) * tf.rsqrt(group_var + self.epsilon) \
+                            * self.gamma + self.beta
+                    normed = tf.reshape(normed, tf.shape(x))
+                    normed.set_shape(x.get_shape())
+                    return normed
         else:
             mean, var = self.ema_mean, self.ema_var
 
@@ -47,6 +67,13 @@ class batch_norm(object):
 
         return normed
 
+    def ema_update(self, mean, var):
+        """Op moving the existing averages towards `mean` and `var`, like
+        the update `__call__` builds with `update_ema`."""
+        decay = self.momentum
+        return tf.group(tf.assign_sub(self.ema_mean, (1 - decay) * (self.ema_mean - mean)),
+                        tf.assign_sub(self.ema_var, (1 - decay) * (self.ema_var - var)))
+
 def binary_cross_entropy(preds, targets, name=None):
     """Computes binary cross entropy given `preds`.
 
@@ -85,22 +112,48 @@ def conv2d(input_, output_dim,
 
         return conv
 
+def deconv2d(input_, w, output_shape, d_h=2, d_w=2):
+    """Transposed convolution by filter `w`; a `None` batch size in
+    `output_shape` is taken from `input_` at run time."""
+    static_shape = list(output_shape)
+    if output_shape[0] is None:
+        output_shape = tf.stack([tf.shape(input_)[0]] + static_shape[1:])
+
+    try:
+        deconv = tf.nn.conv2d_transpose(input_, w, output_shape=output_shape,
+                            strides=[1, d_h, d_w, 1])
+
+    # Support for verisons of TensorFlow before 0.7.0
+    except AttributeError:
+        deconv = tf.nn.deconv2d(input_, w, output_shape=output_shape,
+                            strides=[1, d_h, d_w, 1])
+    deconv.set_shape(static_shape)
+    return deconv
+
+def fake_quant(x, lo, hi, bits=8):
+    """Rounds `x` to the 2**bits levels spanning [lo, hi]; the gradient
+    passes straight through."""
+    scale = (hi - lo) / (2**bits - 1)
+    q = tf.round((tf.clip_by_value(x, lo, hi) - lo) / scale) * scale + lo
+    return x + tf.stop_gradient(q - x)
+
 def conv2d_transpose(input_, output_shape,
                      k_h=5, k_w=5, d_h=2, d_w=2, stddev=0.02,
-                     name="conv2d_transpose", with_w=False):
+                     name="conv2d_transpose", with_w=False, quantize=None):
+    """`quantize`, an input range and a filter (lo, hi, w), runs the layer
+    on inputs rounded to 8 bits over [lo, hi] and on the constant filter
+    `w` instead of the variable, see `quantize.int8_weights`."""
     with tf.variable_scope(name):
         # filter : [height, width, output_channels, in_channels]
         w = tf.get_variable('w', [k_h, k_h, output_shape[-1], input_.get_shape()[-1]],
                             initializer=tf.random_normal_initializer(stddev=stddev))
 
-        try:
-            deconv = tf.nn.conv2d_transpose(input_, w, output_shape=output_shape,
-                                strides=[1, d_h, d_w, 1])
-
-        # Support for verisons of TensorFlow before 0.7.0
-        except AttributeError:
-            deconv = tf.nn.deconv2d(input_, w, output_shape=output_shape,
-                                strides=[1, d_h, d_w, 1])
+        if quantize is None:
+            deconv = deconv2d(input_, w, output_shape, d_h, d_w)
+        else:
+            lo, hi, w_quantized = quantize
+            deconv = deconv2d(fake_quant(input_, lo, hi), tf.constant(w_quantized, name='w_int8'),
+                              output_shape, d_h, d_w)
 
         biases = tf.get_variable('biases', [output_shape[-1]], initializer=tf.constant_initializer(0.0))
         # deconv = tf.reshape(tf.nn.bias_add(deconv, biases), deconv.get_shape())
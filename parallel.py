@@ -0,0 +1,133 @@
+"""
+Data-parallel training helpers.
+
+In-process towers (`--num_towers`) split every batch between copies of the
+G/D graph in one session and average their gradients before Adam
+(`average_gradients`, used by `GAN.build_tower_steps`).
+
+Local processes (`--num_procs`) each train on their own shard of the
+dataset and average their parameters every `--sync_freq` steps through
+`ParameterAverager`: rank 0 listens on a localhost socket, collects the
+values of every rank and sends back the mean. No outside services are
+involved. A rank that does not connect or answer within the timeout fails
+the run instead of hanging it.
+"""
+from __future__ import division
+from __future__ import print_function
+import sys
+import time
+import threading
+import subprocess
+from multiprocessing.connection import Listener, Client
+import numpy as np
+import tensorflow as tf
+from six.moves import xrange
+
+AUTHKEY = b'stext2image'
+
+
+def average_gradients(tower_grads):
+    """Mean of the per-tower (gradient, variable) lists of
+    `Optimizer.compute_gradients`, all over the same variables."""
+    averaged = []
+    for grads_and_vars in zip(*tower_grads):
+        grads = [g for g, _ in grads_and_vars if g is not None]
+        var = grads_and_vars[0][1]
+        averaged.append((tf.add_n(grads) / len(grads) if grads else None, var))
+    return averaged
+
+
+def launch_processes(num_procs, argv=None):
+    """Runs this script once per rank with `--rank` appended and waits for
+    all of them; returns the worst exit code."""
+    argv = sys.argv if argv is None else argv
+    procs = [subprocess.Popen([sys.executable] + list(argv) + ['--rank=%d' % rank])
+             for rank in xrange(num_procs)]
+    return max(p.wait() for p in procs)
+
+
+class ParameterAverager(object):
+    """Averages `variables` across `num_procs` training processes.
+
+    Every rank must call `average` (and `broadcast`) the same number of
+    times; the calls block until all ranks have arrived, for at most
+    `timeout` seconds.
+    """
+    def __init__(self, sess, variables, rank, num_procs, port=52170, timeout=300.):
+        self.sess = sess
+        self.variables = list(variables)
+        self.rank = rank
+        self.num_procs = num_procs
+        self.timeout = timeout
+        self.sync_time = 0.
+
+        with tf.name_scope('parameter_averaging'):
+            self.values = [tf.placeholder(v.dtype.base_dtype, v.get_shape()) for v in self.variables]
+            self.assign = tf.group(*[tf.assign(v, p) for v, p in zip(self.variables, self.values)])
+
+        address = ('localhost', port)
+        if rank == 0:
+            self.listener = Listener(address, authkey=AUTHKEY)
+            # Listener.accept has no timeout, a thread waits for the ranks
+            self.conns = []
+            accepter = threading.Thread(target=lambda: self.conns.extend(
+                self.listener.accept() for _ in xrange(num_procs - 1)))
+            accepter.daemon = True
+            accepter.start()
+            accepter.join(timeout)
+            if len(self.conns) < num_procs - 1:
+                raise RuntimeError("%d of %d training processes connected in %gs"
+                                   % (len(self.conns) + 1, num_procs, timeout))
+        else:
+            # rank 0 may still be building its graph
+            deadline = time.time() + timeout
+            while True:
+                try:
+                    self.conn = Client(address, authkey=AUTHKEY)
+                    break
+                except (IOError, OSError):
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(0.5)
+
+    def _recv(self, conn):
+        if not conn.poll(self.timeout):
+            raise RuntimeError("no parameters from the other training processes in %gs" % self.timeout)
+        return conn.recv()
+
+    def _set(self, values):
+        self.sess.run(self.assign, feed_dict=dict(zip(self.values, values)))
+
+    def broadcast(self):
+        """Gives every rank the values of rank 0."""
+        if self.rank == 0:
+            values = self.sess.run(self.variables)
+            for conn in self.conns:
+                conn.send(values)
+        else:
+            self._set(self._recv(self.conn))
+
+    def average(self):
+        start_time = time.time()
+        values = self.sess.run(self.variables)
+        if self.rank == 0:
+            total = [np.array(v, dtype=np.float64) for v in values]
+            for conn in self.conns:
+                for t, v in zip(total, self._recv(conn)):
+                    t += v
+            mean = [(t / self.num_procs).astype(v.dtype) for t, v in zip(total, values)]
+            for conn in self.conns:
+                conn.send(mean)
+        else:
+            self.conn.send(values)
+            mean = self._recv(self.conn)
+        self._set(mean)
+        self.sync_time += time.time() - start_time
+
+    def close(self):
+        if self.rank == 0:
+            for conn in self.conns:
+                conn.close()
+            self.listener.close()
+        else:
+            self.conn.close()
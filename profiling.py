@@ -0,0 +1,114 @@
+"""
+Instrumentation of the training and completion loops.
+
+`PhaseTimer` measures the wall time of the named phases of every step
+(data, D step, G steps, ...) and keeps rolling statistics over the last
+`window` steps. `JsonlLog` appends one json object per line, for the
+per-step phase times and the periodic rolling statistics. `Tracer` runs
+the session calls of selected steps with full tracing and writes their
+`RunMetadata` as Chrome traces, to open in chrome://tracing.
+"""
+from __future__ import division
+from __future__ import print_function
+import os
+import json
+import time
+import collections
+import contextlib
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+
+def parse_steps(steps):
+    """Steps of a comma-separated list like '10,20,500'."""
+    return set(int(s) for s in steps.split(',') if s.strip()) if steps else set()
+
+
+class PhaseTimer(object):
+    """Per-step phase times and their rolling statistics."""
+    def __init__(self, window=100):
+        self.window = window
+        self.current = collections.OrderedDict()
+        self.history = collections.OrderedDict()
+        self.totals = collections.defaultdict(float)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start_time)
+
+    def add(self, name, seconds):
+        """Adds time measured elsewhere to phase `name` of this step."""
+        self.current[name] = self.current.get(name, 0.) + seconds
+
+    def end_step(self):
+        """Closes the step; returns its phase times in seconds."""
+        step, self.current = self.current, collections.OrderedDict()
+        for name, seconds in step.items():
+            if name not in self.history:
+                self.history[name] = collections.deque(maxlen=self.window)
+            self.history[name].append(seconds)
+            self.totals[name] += seconds
+        return step
+
+    def stats(self):
+        """{phase: count, mean, p50, p99, max over the window and total},
+        in seconds; phases that do not run every step are averaged over
+        the steps they ran in."""
+        stats = collections.OrderedDict()
+        for name, times in self.history.items():
+            times = np.array(times)
+            stats[name] = {'count': len(times), 'mean': float(times.mean()),
+                           'p50': float(np.percentile(times, 50)), 'p99': float(np.percentile(times, 99)),
+                           'max': float(times.max()), 'total': self.totals[name]}
+        return stats
+
+    def summary(self):
+        return ', '.join('%s %.4f' % (name, s['mean']) for name, s in self.stats().items())
+
+
+class JsonlLog(object):
+    """Appends records to `path`, one json object per line."""
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._f = open(path, 'a')
+
+    def write(self, **record):
+        record.setdefault('time', time.time())
+        self._f.write(json.dumps(record, sort_keys=True) + '\n')
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+
+class Tracer(object):
+    """Session runs with full tracing for the steps in `steps`; the first
+    run of each name in a traced step is written to `trace_dir` as
+    `<name>_<step>.json`."""
+    def __init__(self, steps, trace_dir='traces'):
+        self.steps = set(steps)
+        self.trace_dir = trace_dir
+        self._done = set()
+
+    def run(self, sess, step, name, fetches, feed_dict=None):
+        if step not in self.steps or (step, name) in self._done:
+            return sess.run(fetches, feed_dict=feed_dict)
+        options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+        result = sess.run(fetches, feed_dict=feed_dict, options=options, run_metadata=run_metadata)
+        self._done.add((step, name))
+
+        if not os.path.exists(self.trace_dir):
+            os.makedirs(self.trace_dir)
+        path = os.path.join(self.trace_dir, '%s_%06d.json' % (name, step))
+        with open(path, 'w') as f:
+            f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+        print(" [*] Wrote trace of %s at step %d to %s" % (name, step, path))
+        return result
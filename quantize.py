@@ -0,0 +1,172 @@
+"""
+Simulated int8 post-training quantization of the completion generator,
+to check the accuracy of an int8 deployment.
+
+Calibration runs the generator of the completion loop (see
+`GAN.completion_loss`) on a few training batches and records the range
+of the input of every deconv layer g_h0..g_h4. With these ranges the
+generator runs each deconv on inputs rounded to 8 bits and on weights
+rounded to per-output-channel int8 (`ops.conv2d_transpose(quantize=...)`).
+The arithmetic stays float32, so this is no faster than the float
+generator: it measures the accuracy int8 would have, it does not deliver
+its speed (`weights_io.py --quantize` stores real int8 weights). The
+weights are rounded once, into constants, by `int8_weights`; the gradient
+with respect to z passes straight through the input rounding, so the
+completion loop works unchanged. The report compares the simulated int8
+and float32 generators on held-out batches: sample error, PSNR and
+completion loss.
+
+    python quantize.py --checkpointDir checkpoints_face_pretrained --dataset ./datasets/celeba/train \
+        --text_path datasets/celeba/imAttrs.pkl --text_vector_dim 18 --lam1 100 --lam2 1 --outPath quant.json
+
+then pass `--simulatedInt8 quant.json` to test.py or server.py.
+"""
+from __future__ import division
+from __future__ import print_function
+import os
+import json
+import time
+import argparse
+from glob import glob
+import numpy as np
+from six.moves import xrange
+
+from weights_io import quantize_channels, dequantize_channels
+
+LAYERS = ['g_h0', 'g_h1', 'g_h2', 'g_h3', 'g_h4']
+
+
+def load_quant_ranges(path):
+    """{layer name: (lo, hi)} of a calibration file."""
+    with open(path, 'r') as f:
+        ranges = json.load(f)['ranges']
+    return dict((name, tuple(r)) for name, r in ranges.items())
+
+
+def int8_weights(model, ranges):
+    """{layer name: (lo, hi, w)}, `ranges` with the current deconv filter
+    `w` of each layer rounded to per-output-channel int8 and back, as
+    numpy arrays; call it after `model.load`."""
+    variables = dict((v.op.name, v) for v in model.model_variables)
+    filters = model.sess.run([variables['%s/w' % name] for name in LAYERS])
+    return dict((name, tuple(ranges[name]) + (dequantize_channels(*quantize_channels(w, 2), axis=2),))
+                for name, w in zip(LAYERS, filters))
+
+
+def calibrate(model, batches):
+    """Ranges of the deconv inputs of the completion generator over
+    `batches` of (z, t)."""
+    model.generator(model.z, model.t, update_ema=False)
+    inputs = list(model.deconv_inputs)
+    lo = np.full(len(inputs), np.inf)
+    hi = np.full(len(inputs), -np.inf)
+    for z, t in batches:
+        values = model.sess.run(inputs, feed_dict={ model.z: z, model.t: t })
+        lo = np.minimum(lo, [v.min() for v in values])
+        hi = np.maximum(hi, [v.max() for v in values])
+    # keep every range non-empty, relu outputs of a dead layer are all 0
+    hi = np.maximum(hi, lo + 1e-6)
+    return dict((name, (float(l), float(h))) for name, l, h in zip(LAYERS, lo, hi))
+
+
+def accuracy_report(model, ranges, batches):
+    """Float32 vs simulated int8 generator on `batches` of (z, t, images)."""
+    G_f, loss_f = model.completion_loss(model.z, model.t, model.images)
+    G_q, loss_q = model.completion_loss(model.z, model.t, model.images,
+                                        quantize=int8_weights(model, ranges))
+    abs_err, max_err, psnr, losses_f, losses_q = [], [], [], [], []
+    time_f = time_q = 0.
+    for z, t, images in batches:
+        feed = { model.z: z, model.t: t, model.images: images }
+        start_time = time.time()
+        samples_f, l_f = model.sess.run([G_f, loss_f], feed_dict=feed)
+        time_f += time.time() - start_time
+        start_time = time.time()
+        samples_q, l_q = model.sess.run([G_q, loss_q], feed_dict=feed)
+        time_q += time.time() - start_time
+
+        diff = np.abs(samples_f - samples_q)
+        abs_err.append(diff.mean())
+        max_err.append(diff.max())
+        # images in [-1, 1], psnr on the [0, 1] scale
+        mse = np.mean((diff / 2)**2, axis=(1, 2, 3))
+        psnr.extend(10 * np.log10(1. / np.maximum(mse, 1e-12)))
+        losses_f.extend(l_f)
+        losses_q.extend(l_q)
+
+    losses_f, losses_q = np.array(losses_f), np.array(losses_q)
+    rel = np.abs(losses_q - losses_f) / np.maximum(np.abs(losses_f), 1e-12)
+    return {'batches': len(abs_err),
+            'sample_mean_abs_err': float(np.mean(abs_err)),
+            'sample_max_abs_err': float(np.max(max_err)),
+            'sample_psnr': float(np.mean(psnr)),
+            'loss_float32': float(losses_f.mean()),
+            'loss_quantized': float(losses_q.mean()),
+            'loss_mean_rel_err': float(rel.mean()),
+            'loss_max_rel_err': float(rel.max()),
+            'time_float32': time_f,
+            'time_quantized': time_q}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--imgSize', type=int, default=64)
+    parser.add_argument('--batchSize', type=int, default=64)
+    parser.add_argument('--text_vector_dim', type=int, default=100)
+    parser.add_argument('--lam1', type=float, default=0.1)
+    parser.add_argument('--lam2', type=float, default=0.1)
+    parser.add_argument('--checkpointDir', type=str, default='checkpoint')
+    parser.add_argument('--dataset', type=str, default='./datasets/celeba/train') # calibration and report images
+    parser.add_argument('--text_path', type=str, default='text_embeddings.pkl')
+    parser.add_argument('--text_store', type=str, default='')
+    parser.add_argument('--calibBatches', type=int, default=8) # training batches used for calibration
+    parser.add_argument('--reportBatches', type=int, default=4) # further batches compared in the report
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--outPath', type=str, default='quant.json')
+    args = parser.parse_args()
+
+    assert(os.path.exists(args.checkpointDir))
+
+    import tensorflow as tf
+    from model import GAN
+    from utils import get_image
+
+    rng = np.random.RandomState(args.seed)
+    image_files = sorted(glob(os.path.join(args.dataset, "*.png")))
+    rng.shuffle(image_files)
+    nBatches = args.calibBatches + args.reportBatches
+    assert(len(image_files) >= nBatches * args.batchSize)
+
+    with tf.Session() as sess:
+        model = GAN(sess,
+                    image_size=args.imgSize,
+                    batch_size=args.batchSize,
+                    text_vector_dim=args.text_vector_dim,
+                    checkpoint_dir=args.checkpointDir,
+                    lam1=args.lam1,
+                    lam2=args.lam2,
+                    inference=True,
+                   )
+        isLoaded = model.load(args.checkpointDir)
+        assert(isLoaded)
+        text_store = model.open_text_store(args)
+
+        batches = []
+        for idx in xrange(nBatches):
+            batch_files = image_files[idx*args.batchSize:(idx+1)*args.batchSize]
+            batch_z = rng.uniform(-1, 1, [args.batchSize, model.z_dim]).astype(np.float32)
+            batch_t = text_store.take(text_store.rows(batch_files))
+            batch_images = np.array([get_image(f, args.imgSize, is_crop=False) for f in batch_files]).astype(np.float32)
+            batches.append((batch_z, batch_t, batch_images))
+
+        ranges = calibrate(model, [(z, t) for z, t, _ in batches[:args.calibBatches]])
+        report = accuracy_report(model, ranges, batches[args.calibBatches:])
+        for name in LAYERS:
+            print(" [*] %s input range [%.4f, %.4f]" % ((name,) + ranges[name]))
+        for key in sorted(report):
+            print(" [*] %s: %s" % (key, report[key]))
+
+        with open(args.outPath, 'w') as f:
+            json.dump({'ranges': ranges, 'bits': 8, 'calib_batches': args.calibBatches,
+                       'report': report}, f, indent=2)
+        print(" [*] Wrote calibration to %s" % args.outPath)
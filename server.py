@@ -0,0 +1,418 @@
+"""
+Long-lived local completion server.
+
+Builds the graph and restores the checkpoint once, then serves completion
+requests over HTTP on a local port or a Unix socket, on CPU only.
+Requests that arrive within `--maxWait` seconds of each other are run as
+one session batch of at most `--maxBatch` images.
+
+    python server.py --checkpointDir checkpoints_face_pretrained --text_vector_dim 18 \
+        --lam1 100 --lam2 1 --lr 0.001 --port 8000
+
+POST /complete with a json body
+    {"image": <base64 png>, "attributes": [...], "mask": "right", "iterations": 500}
+where the png is either the sketch alone (imgSize x imgSize) or the
+sketch/image pair (imgSize x 2*imgSize) used by test.py; the reply holds
+the completed and the generated pair as base64 pngs, the final loss and
+the iterations run. GET /metrics returns latency and throughput figures.
+
+The completion generator and discriminator normalize with batch
+statistics, so a result depends on the rows it is batched with. Every
+batch is therefore run at `--maxBatch` rows, the requests repeated to
+fill it with the copies held frozen: the batch size no longer varies with
+the traffic and a lone request is normalized by copies of itself, but
+requests batched together still share their statistics. `--noPadding`
+runs each batch at its own size instead, faster for lone requests.
+"""
+from __future__ import division
+from __future__ import print_function
+import os
+# the server runs on CPU only, keep tensorflow off any visible GPU
+os.environ['CUDA_VISIBLE_DEVICES'] = ''
+import io
+import json
+import time
+import base64
+import argparse
+import threading
+import collections
+import traceback
+import numpy as np
+import scipy.misc
+import tensorflow as tf
+from six.moves import xrange
+from six.moves import queue
+from six.moves import socketserver
+from six.moves import BaseHTTPServer
+
+from model import GAN
+from utils import rgb2gray, kl_divergence_rows, max_rss_mb
+from completion import ConvergenceTracker
+from trajectories import to_uint8
+from quantize import load_quant_ranges, int8_weights
+
+
+def decode_png(data, image_size):
+    """base64 png to a [image_size, 2*image_size, 3] float32 image in [-1, 1];
+    a lone sketch is placed in the left half."""
+    img = scipy.misc.imread(io.BytesIO(base64.b64decode(data)), mode='RGB')
+    if img.shape[0] != image_size or img.shape[1] not in (image_size, 2*image_size):
+        raise ValueError("expected a %dx%d sketch or %dx%d pair, got %dx%d"
+                         % (image_size, image_size, image_size, 2*image_size, img.shape[0], img.shape[1]))
+    image = np.zeros([image_size, 2*image_size, 3], dtype=np.float32)
+    image[:, :img.shape[1]] = img/127.5 - 1.
+    return image
+
+
+def encode_png(image):
+    buf = io.BytesIO()
+    scipy.misc.toimage(to_uint8(image)).save(buf, format='PNG')
+    return base64.b64encode(buf.getvalue()).decode('ascii')
+
+
+def make_mask(side, image_size):
+    mask = np.ones([image_size, 2*image_size, 3], dtype=np.float32)
+    if side == 'right':
+        mask[:, image_size:, :] = 0.0
+    elif side == 'left':
+        mask[:, :image_size, :] = 0.0
+    else:
+        raise ValueError("mask must be 'left' or 'right', got %r" % side)
+    return mask
+
+
+class CompletionJob(object):
+    def __init__(self, image, t, mask, n_iter):
+        self.image = image
+        self.t = t
+        self.mask = mask
+        self.n_iter = n_iter
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self.submit_time = time.time()
+        self.start_time = None
+        self.batch_size = 0
+
+
+class Completer(object):
+    """Runs the completion of a list of jobs as one session batch.
+
+    z is initialized as in `GAN.test` (lowest kl divergence of `init_rounds`
+    random draws), then optimized by the in-graph loop until every job has
+    used its iteration budget or converged. Jobs are answered as soon as
+    they stop, not when the whole batch is done.
+
+    With `batch_size` the batch is filled up to that many rows with
+    copies of the jobs, wrapping around, which are never optimized; see
+    the module docstring.
+    """
+    def __init__(self, model, init_rounds=30, steps_per_run=20, tol=0., grad_tol=0., patience=0,
+                 batch_size=None):
+        self.model = model
+        self.init_rounds = init_rounds
+        self.steps_per_run = steps_per_run
+        self.tol = tol
+        self.grad_tol = grad_tol
+        self.patience = patience
+        self.batch_size = batch_size
+
+    def run(self, jobs):
+        model, sess = self.model, self.model.sess
+        size = model.image_size
+        # row r holds job rows[r] % len(jobs), rows past the jobs are frozen copies
+        rows = np.arange(max(self.batch_size or 0, len(jobs))) % len(jobs)
+        n = len(rows)
+        images = np.array([j.image for j in jobs], dtype=np.float32)[rows]
+        batch_t = np.array([j.t for j in jobs], dtype=np.float32)[rows]
+        budgets = np.array([j.n_iter for j in jobs], dtype=np.int64)[rows]
+        budgets[len(jobs):] = 0
+        for j in jobs:
+            j.start_time = time.time()
+            j.batch_size = len(jobs)
+
+        zhats_all = np.random.uniform(-1, 1, size=(self.init_rounds, n, model.z_dim)).astype(np.float32)
+        in_flat = rgb2gray(images[:,:,:size,:]).reshape(n, -1) + 1
+        kl_all = np.empty((self.init_rounds, n))
+        for i in xrange(self.init_rounds):
+            G_imgs = sess.run(model.G, feed_dict={ model.z: zhats_all[i], model.t: batch_t })
+            kl_all[i] = kl_divergence_rows(in_flat, rgb2gray(G_imgs[:,:,:size,:]).reshape(n, -1) + 1)
+        # the copies start from, and keep, the z chosen for their job
+        zhats_init = zhats_all[np.argmin(kl_all, 0), np.arange(n)][rows]
+
+        sess.run(model.c_load, feed_dict={ model.z: zhats_init, model.images: images, model.t: batch_t })
+        tracker = ConvergenceTracker(n, tol=self.tol, grad_tol=self.grad_tol, patience=self.patience,
+                                     max_iters=budgets, active=budgets > 0)
+        stopped = ~tracker.active
+        stopped[len(jobs):] = False
+        while True:
+            if stopped.any():
+                self.answer(jobs, stopped, tracker)
+            if tracker.done():
+                break
+            steps = int(min(self.steps_per_run, np.min((budgets - tracker.iters)[tracker.active])))
+            loss, g, _ = sess.run([model.c_last_loss, model.c_last_grad, model.c_step], feed_dict={
+                model.c_steps: steps, model.c_active: tracker.active.astype(np.float32) })
+            stopped = tracker.update(loss, g, steps=steps)
+
+    def answer(self, jobs, stopped, tracker):
+        loss, G_imgs = self.model.sess.run([self.model.c_loss, self.model.c_G])
+        for i in np.flatnonzero(stopped):
+            job = jobs[i]
+            completed = job.image*job.mask + G_imgs[i]*(1.-job.mask)
+            job.result = {'image': encode_png(completed),
+                          'generated': encode_png(G_imgs[i]),
+                          'loss': float(loss[i]),
+                          'iterations': int(tracker.iters[i])}
+            job.done.set()
+
+
+class ServerMetrics(object):
+    """Request/batch counters and latency percentiles over the last
+    `window` requests."""
+    def __init__(self, window=1000):
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.images = 0
+        self.busy_time = 0.
+        self.latency = collections.deque(maxlen=window)
+        self.queue_time = collections.deque(maxlen=window)
+        self.iterations = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+
+    def add_batch(self, size, run_time):
+        with self.lock:
+            self.batches += 1
+            self.images += size
+            self.busy_time += run_time
+            self.batch_sizes.append(size)
+
+    def add_request(self, job):
+        with self.lock:
+            self.requests += 1
+            if job.error is not None:
+                self.errors += 1
+                return
+            now = time.time()
+            self.latency.append(now - job.submit_time)
+            self.queue_time.append(job.start_time - job.submit_time)
+            self.iterations.append(job.result['iterations'])
+
+    def snapshot(self):
+        def percentiles(values):
+            if not values:
+                return None
+            p50, p90, p99 = np.percentile(list(values), [50, 90, 99])
+            return {'p50': p50, 'p90': p90, 'p99': p99, 'mean': float(np.mean(values))}
+
+        with self.lock:
+            uptime = time.time() - self.start_time
+            return {'uptime': uptime,
+                    'requests': self.requests,
+                    'errors': self.errors,
+                    'batches': self.batches,
+                    'images': self.images,
+                    'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else None,
+                    'images_per_sec': self.images / uptime,
+                    'images_per_busy_sec': self.images / self.busy_time if self.busy_time else None,
+                    'utilization': self.busy_time / uptime,
+                    'latency': percentiles(self.latency),
+                    'queue_time': percentiles(self.queue_time),
+                    'iterations': percentiles(self.iterations)}
+
+
+class MicroBatcher(object):
+    """Collects jobs from the request threads into batches: a batch is run
+    once it holds `max_batch` jobs or `max_wait` seconds after its first
+    job arrived. `serve` runs the batches on the calling thread, the one
+    owning the session."""
+    def __init__(self, completer, max_batch=16, max_wait=0.01, metrics=None):
+        self.completer = completer
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.metrics = metrics if metrics is not None else ServerMetrics()
+        self._jobs = queue.Queue()
+        self._stop = threading.Event()
+
+    def submit(self, job):
+        self._jobs.put(job)
+
+    def next_batch(self):
+        try:
+            jobs = [self._jobs.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = jobs[0].submit_time + self.max_wait
+        while len(jobs) < self.max_batch:
+            wait = deadline - time.time()
+            try:
+                jobs.append(self._jobs.get(timeout=wait) if wait > 0 else self._jobs.get_nowait())
+            except queue.Empty:
+                break
+        return jobs
+
+    def serve(self):
+        while not self._stop.is_set():
+            jobs = self.next_batch()
+            if not jobs:
+                continue
+            start_time = time.time()
+            try:
+                self.completer.run(jobs)
+            except Exception:
+                error = traceback.format_exc()
+                print(" [!] completion batch failed:\n" + error)
+                for job in jobs:
+                    if not job.done.is_set():
+                        job.error = error
+                        job.done.set()
+            self.metrics.add_batch(len(jobs), time.time() - start_time)
+
+    def stop(self):
+        self._stop.set()
+
+
+class CompletionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def reply(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.reply(200, self.server.batcher.metrics.snapshot())
+        elif self.path == '/health':
+            self.reply(200, {'status': 'ok'})
+        else:
+            self.reply(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        if self.path != '/complete':
+            self.reply(404, {'error': 'unknown path %s' % self.path})
+            return
+        config = self.server.config
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+            image = decode_png(request['image'], config.imgSize)
+            t = np.array(request['attributes'], dtype=np.float32)
+            if t.shape != (config.text_vector_dim,):
+                raise ValueError("attributes must have length %d" % config.text_vector_dim)
+            mask = make_mask(request.get('mask', 'right'), config.imgSize)
+            n_iter = min(int(request.get('iterations', config.nIter)), config.nIter)
+        # a corrupt png fails in the image decoder with IOError/OSError
+        except (KeyError, TypeError, ValueError, IOError, OSError) as e:
+            self.reply(400, {'error': str(e)})
+            return
+
+        job = CompletionJob(image, t, mask, max(n_iter, 0))
+        self.server.batcher.submit(job)
+        job.done.wait()
+        self.server.batcher.metrics.add_request(job)
+        if job.error is not None:
+            self.reply(500, {'error': job.error})
+            return
+        result = dict(job.result)
+        result['latency'] = time.time() - job.submit_time
+        result['queue_time'] = job.start_time - job.submit_time
+        result['batch_size'] = job.batch_size
+        self.reply(200, result)
+
+    def log_message(self, format, *args):
+        if self.server.config.verbose:
+            print(format % args)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(config, batcher):
+    if config.socket:
+        if os.path.exists(config.socket):
+            os.remove(config.socket)
+        server = ThreadingUnixHTTPServer(config.socket, CompletionHandler)
+    else:
+        server = ThreadingHTTPServer((config.host, config.port), CompletionHandler)
+    server.config = config
+    server.batcher = batcher
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lr', type=float, default=0.01)
+    parser.add_argument('--momentum', type=float, default=0.9)
+    parser.add_argument('--stepsPerRun', type=int, default=20) # completion iterations per session call
+    parser.add_argument('--nIter', type=int, default=1000) # default and largest iteration budget of a request
+    parser.add_argument('--convTol', type=float, default=0.)
+    parser.add_argument('--patience', type=int, default=0)
+    parser.add_argument('--gradTol', type=float, default=0.)
+    parser.add_argument('--initRounds', type=int, default=30)
+    parser.add_argument('--simulatedInt8', type=str, default='') # calibration file from quantize.py, serves the simulated int8 generator (accuracy check, not faster)
+    parser.add_argument('--imgSize', type=int, default=64)
+    parser.add_argument('--text_vector_dim', type=int, default=100)
+    parser.add_argument('--lam1', type=float, default=0.1)
+    parser.add_argument('--lam2', type=float, default=0.1)
+    parser.add_argument('--checkpointDir', type=str, default='checkpoint')
+    parser.add_argument('--maxBatch', type=int, default=16) # most requests run in one session batch
+    parser.add_argument('--maxWait', type=float, default=0.01) # seconds a batch waits for more requests after its first
+    parser.add_argument('--noPadding', action='store_true') # run each batch at its own size, not filled to maxBatch: faster for lone requests, but results vary with the batch size
+    parser.add_argument('--threads', type=int, default=0) # tensorflow intra-op threads, 0 for all cores
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--socket', type=str, default='') # serve on this Unix socket instead of host:port
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--fullGraph', action='store_true') # build the whole training graph, to compare startup time and memory
+    args = parser.parse_args()
+
+    assert(os.path.exists(args.checkpointDir))
+
+    start_time = time.time()
+    config = tf.ConfigProto(device_count={'GPU': 0}, intra_op_parallelism_threads=args.threads)
+    with tf.Session(config=config) as sess:
+        model = GAN(sess,
+                    image_size=args.imgSize,
+                    batch_size=args.maxBatch,
+                    text_vector_dim=args.text_vector_dim,
+                    checkpoint_dir=args.checkpointDir,
+                    lam1=args.lam1,
+                    lam2=args.lam2,
+                    inference=not args.fullGraph,
+                   )
+        isLoaded = model.load(args.checkpointDir)
+        assert(isLoaded)
+        model.build_completion(args.lr, args.momentum,
+                               int8_weights(model, load_quant_ranges(args.simulatedInt8))
+                               if args.simulatedInt8 else None)
+        model.init_unsaved_variables()
+
+        completer = Completer(model, args.initRounds, args.stepsPerRun,
+                              args.convTol, args.gradTol, args.patience,
+                              None if args.noPadding else args.maxBatch)
+        batcher = MicroBatcher(completer, args.maxBatch, args.maxWait)
+        server = make_server(args, batcher)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        print(" [*] Serving on %s after %.1fs startup, max resident memory %.1f MB" % (
+            args.socket or '%s:%d' % (args.host, args.port), time.time() - start_time, max_rss_mb()))
+
+        try:
+            batcher.serve()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            batcher.stop()
+            server.shutdown()
+            if args.socket and os.path.exists(args.socket):
+                os.remove(args.socket)
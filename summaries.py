@@ -0,0 +1,36 @@
+"""
+Cheap scalar logging for the training loop.
+"""
+from __future__ import division
+import tensorflow as tf
+
+
+class ScalarAccumulator(object):
+    """Averages scalar values in process and writes the means to `writer`
+    as one summary every `flush_every` steps, instead of serializing a
+    summary op on every step."""
+    def __init__(self, writer, flush_every=10):
+        self.writer = writer
+        self.flush_every = max(flush_every, 1)
+        self._sums = {}
+        self._counts = {}
+        self._last_flush = None
+
+    def add(self, values, step):
+        for tag, value in values.items():
+            self._sums[tag] = self._sums.get(tag, 0.) + float(value)
+            self._counts[tag] = self._counts.get(tag, 0) + 1
+        if self._last_flush is None:
+            self._last_flush = step - 1
+        if step - self._last_flush >= self.flush_every:
+            self.flush(step)
+
+    def flush(self, step):
+        if not self._sums:
+            return
+        summary = tf.Summary(value=[
+            tf.Summary.Value(tag=tag, simple_value=self._sums[tag] / self._counts[tag])
+            for tag in sorted(self._sums)])
+        self.writer.add_summary(summary, step)
+        self._sums, self._counts = {}, {}
+        self._last_flush = step
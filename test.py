@@ -3,6 +3,8 @@
 # [2017-07] Modifications for sText2Image: Shangzhe Wu
 #   + License: MIT
 
+import time
+start_time = time.time()
 import argparse
 import os
 import tensorflow as tf
@@ -12,7 +14,19 @@ from model import GAN
 parser = argparse.ArgumentParser()
 parser.add_argument('--lr', type=float, default=0.01)
 parser.add_argument('--momentum', type=float, default=0.9)
+parser.add_argument('--stepsPerRun', type=int, default=20) # completion iterations per session call, convergence is checked between calls
 parser.add_argument('--nIter', type=int, default=1000)
+parser.add_argument('--convTol', type=float, default=0.) # stop a sample once its loss improves by less than this fraction...
+parser.add_argument('--patience', type=int, default=0) # ...on this many consecutive checks, made every stepsPerRun (at most 20) iterations (0 with convTol 0: never)
+parser.add_argument('--gradTol', type=float, default=0.) # stop a sample once its gradient norm is below this
+parser.add_argument('--nRestarts', type=int, default=1) # latent candidates optimized per image, the best one is kept
+parser.add_argument('--initRounds', type=int, default=30) # random z draws scored by kl divergence before completion
+parser.add_argument('--saveInitImgs', action='store_true') # write the generated images of every initialization round
+parser.add_argument('--simulatedInt8', type=str, default='') # calibration file from quantize.py, runs completion on the simulated int8 generator (accuracy check, not faster)
+parser.add_argument('--profileLog', type=str, default='') # append per-batch phase times and their statistics to this JSONL file
+parser.add_argument('--traceBatches', nargs='+', type=int, default=[]) # batches whose first kl init and completion calls are traced
+parser.add_argument('--traceDir', type=str, default='traces') # where the Chrome traces (chrome://tracing) are written
+parser.add_argument('--fullGraph', action='store_true') # build the whole training graph as before, to compare startup time and memory
 parser.add_argument('--imgSize', type=int, default=64)
 parser.add_argument('--batchSize', type=int, default=64)
 parser.add_argument('--text_vector_dim', type=int, default=100)
@@ -21,7 +35,11 @@ parser.add_argument('--lam2', type=float, default=0.1) # Hyperparameter for perc
 #parser.add_argument('--lam3', type=float, default=0.1) # Hyperparameter for wrong example [0.1]
 parser.add_argument('--checkpointDir', type=str, default='checkpoint')
 parser.add_argument('--outDir', type=str, default='results')
+parser.add_argument('--outFormat', type=str, choices=['png', 'store'], default='png') # png grids per batch, or one compressed trajectory store per run, one zip per batch (see trajectories.py)
+parser.add_argument('--writerThreads', type=int, default=2) # threads encoding and writing output images, 0 to write synchronously
+parser.add_argument('--writerQueue', type=int, default=16) # image writes queued before the completion loop blocks
 parser.add_argument('--text_path', type=str, default='text_embeddings.pkl')
+parser.add_argument('--text_store', type=str, default='') # embedding store directory, used instead of --text_path
 parser.add_argument('--maskType', type=str,
                     choices=['random', 'center', 'left', 'right', 'full'],
                     default='right')
@@ -29,6 +47,7 @@ parser.add_argument('--attributes', nargs='+', type=int, default=[None])
 parser.add_argument('imgs', type=str, nargs='+')
 
 args = parser.parse_args()
+args.startTime = start_time
 
 assert(os.path.exists(args.checkpointDir))
 
@@ -42,5 +61,6 @@ with tf.Session(config=config) as sess:
                 checkpoint_dir=args.checkpointDir, 
                 lam1=args.lam1, 
                 lam2=args.lam2,
+                inference=not args.fullGraph,
                )
     model.test(args)
@@ -7,11 +7,14 @@
 #   + License: MIT
 
 import os
+import sys
 import scipy.misc
 import numpy as np
 import tensorflow as tf
 
 from model import GAN
+from image_cache import build_image_cache
+from parallel import launch_processes
 
 flags = tf.app.flags
 flags.DEFINE_integer("epoch", 25, "Epoch to train [25]")
@@ -22,22 +25,69 @@ flags.DEFINE_integer("batch_size", 64, "The size of batch images [64]")
 flags.DEFINE_integer("image_size", 64, "The size of image to use [64]")
 flags.DEFINE_integer("text_vector_dim", 100, "The dimension of input text vector [100]")
 flags.DEFINE_string("dataset", "datasets/celeba/train", "Dataset directory.")
+flags.DEFINE_string("cache_dir", "", "Directory of the decoded image cache, empty to decode pngs every batch []")
+flags.DEFINE_boolean("build_cache", False, "Build or update the image cache of --dataset in --cache_dir and exit [False]")
+flags.DEFINE_integer("num_workers", 2, "Number of batch prefetching workers, 0 to load batches on the training thread [2]")
+flags.DEFINE_integer("prefetch_size", 8, "Number of batches kept ready by the prefetching workers [8]")
+flags.DEFINE_boolean("worker_processes", False, "Prefetch in worker processes instead of threads [False]")
+flags.DEFINE_integer("seed", -1, "Seed of the training batches, -1 for a random one [-1]")
+flags.DEFINE_boolean("fused_step", False, "Run the D update, both G updates and the loss fetches in one session call [False]")
+flags.DEFINE_integer("scalar_summary_freq", 10, "Steps over which the losses are averaged before being written to the log [10]")
+flags.DEFINE_integer("hist_summary_freq", 100, "Steps between histogram summaries, 0 to disable [100]")
+flags.DEFINE_integer("image_summary_freq", 500, "Steps between image summaries of G, 0 to disable [500]")
+flags.DEFINE_integer("sample_freq", 0, "Steps between sample images, 0 for 100*64/batch_size [0]")
+flags.DEFINE_integer("save_freq", 0, "Steps between checkpoints, 0 for 500*64/batch_size [0]")
+flags.DEFINE_integer("keep_checkpoints", 5, "Most recent checkpoints kept [5]")
+flags.DEFINE_float("keep_checkpoint_hours", 10000., "Also keep one checkpoint every this many hours [10000]")
+flags.DEFINE_boolean("async_save", True, "Write checkpoints on a background thread from a snapshot of the variables [True]")
+flags.DEFINE_integer("writer_threads", 2, "Threads encoding and writing sample images, 0 to write on the training thread [2]")
+flags.DEFINE_integer("writer_queue", 16, "Image writes queued before the training loop blocks [16]")
+flags.DEFINE_boolean("fused_discriminator", False, "Run the discriminator once over the real, fake and wrong-text batches concatenated [False]")
+flags.DEFINE_string("d_bn_stats", "split", "Batch norm statistics of the fused discriminator: split (per batch, as three passes) or joint [split]")
+flags.DEFINE_integer("num_towers", 1, "Copies of G and D splitting each batch in one session, gradients averaged [1]")
+flags.DEFINE_integer("num_procs", 1, "Local training processes, each on its own shard of the dataset [1]")
+flags.DEFINE_integer("rank", -1, "Rank of this process, set when --num_procs starts the processes [-1]")
+flags.DEFINE_integer("sync_freq", 10, "Steps between parameter averaging across the processes [10]")
+flags.DEFINE_integer("sync_port", 52170, "Localhost port on which rank 0 averages the parameters [52170]")
+flags.DEFINE_float("sync_timeout", 300., "Seconds to wait for the other processes before failing the run [300]")
+flags.DEFINE_integer("intra_op_threads", 0, "Threads of each op, 0 for the tensorflow default; lower it when running several processes [0]")
+flags.DEFINE_string("profile_log", "", "JSONL file receiving the phase times of every step and their rolling statistics, empty to disable []")
+flags.DEFINE_integer("profile_freq", 100, "Steps between printed (and logged) rolling phase time statistics, 0 to disable [100]")
+flags.DEFINE_string("trace_steps", "", "Comma-separated steps whose session calls are traced to --trace_dir as Chrome traces []")
+flags.DEFINE_string("trace_dir", "traces", "Directory of the Chrome traces [traces]")
 flags.DEFINE_string("checkpoint_dir", "checkpoint", "Directory name to save the checkpoints [checkpoint]")
 flags.DEFINE_string("sample_dir", "samples", "Directory name to save the image samples [samples]")
 flags.DEFINE_string("log_dir", "logs", "Directory name to save the logs [logs]")
 flags.DEFINE_string("text_path", "text_embeddings.pkl", "Path of the text embeddings [text_embeddings.pkl]")
+flags.DEFINE_string("text_store", "", "Embedding store directory built by embedding_store.py, used instead of --text_path []")
 #flags.DEFINE_float("lam1", 0.1, "Hyperparameter for contextual loss [0.1]")
 #flags.DEFINE_float("lam2", 0.1, "Hyperparameter for perceptual loss [0.1]")
 flags.DEFINE_float("lam3", 0.1, "Hyperparameter for wrong examples [0.1]")
+flags.DEFINE_string("negative_mode", "marginal", "Wrong attributes: marginal (per-attribute frequencies), shuffle (another image's) or hard (near table rows) [marginal]")
+flags.DEFINE_integer("hard_candidates", 16, "Table rows drawn per image in hard negative mode [16]")
 FLAGS = flags.FLAGS
 
+if FLAGS.build_cache:
+    assert(FLAGS.cache_dir)
+    build_image_cache(FLAGS.dataset, FLAGS.cache_dir, FLAGS.image_size, is_crop=False)
+    sys.exit(0)
+
+# created before the ranks are launched, which would race to create them
 if not os.path.exists(FLAGS.checkpoint_dir):
     os.makedirs(FLAGS.checkpoint_dir)
 if not os.path.exists(FLAGS.sample_dir):
     os.makedirs(FLAGS.sample_dir)
 
+if FLAGS.num_procs > 1 and FLAGS.rank < 0:
+    # one process per rank, this one only waits for them
+    sys.exit(launch_processes(FLAGS.num_procs))
+
+log_dir = FLAGS.log_dir if FLAGS.rank <= 0 else os.path.join(FLAGS.log_dir, 'rank_%d' % FLAGS.rank)
+
 config = tf.ConfigProto()
 config.gpu_options.allow_growth = True
+if FLAGS.intra_op_threads > 0:
+    config.intra_op_parallelism_threads = FLAGS.intra_op_threads
 with tf.Session(config=config) as sess:
     model = GAN(sess, 
                   image_size=FLAGS.image_size, 
@@ -45,9 +95,11 @@ with tf.Session(config=config) as sess:
                   text_vector_dim=FLAGS.text_vector_dim,
                   checkpoint_dir=FLAGS.checkpoint_dir, 
                   sample_dir=FLAGS.sample_dir, 
-                  log_dir=FLAGS.log_dir, 
+                  log_dir=log_dir, 
                   is_crop=False, 
                   lam3=FLAGS.lam3,
+                  fused_discriminator=FLAGS.fused_discriminator,
+                  d_bn_stats=FLAGS.d_bn_stats,
                  )
 
     model.train(FLAGS)
@@ -0,0 +1,247 @@
+"""
+Output backends for `GAN.test`.
+
+`PngOutput` writes the classic per-batch `hats_imgs_XXXX`/`completed_XXXX`
+directories of png grids and text files. `StoreOutput` appends the same
+run into one `TrajectoryStore`: a directory with one zip archive per
+batch, holding a deflate compressed .npy member per array. Each archive
+is complete once it appears under its name, so an interrupted run keeps
+every finished batch; any batch/array can be read back without touching
+the rest, and the pngs can be rendered later with:
+
+    python trajectories.py results/trajectories --outDir results/pngs --batches 0 3
+
+Images are stored as uint8. Masked and completed images are not stored,
+they are recomposed from the ground truth, the mask and the generated
+images on export.
+"""
+from __future__ import division
+from __future__ import print_function
+import io
+import os
+import argparse
+import threading
+import zipfile
+import numpy as np
+from six.moves import xrange
+
+from image_writer import AsyncImageWriter
+
+STORE_NAME = 'trajectories'
+
+# png layout of every image kind, relative to the output directory
+PNG_PATHS = {
+    'init': 'hats_imgs_{idx:04d}/init_{step:02d}.png',
+    'chosen_init': 'hats_imgs_{idx:04d}/chosen_init.png',
+    'gt': 'hats_imgs_{idx:04d}/gt.png',
+    'masked': 'hats_imgs_{idx:04d}/masked.png',
+    'hats': 'hats_imgs_{idx:04d}/{step:04d}.png',
+    'completed': 'completed_{idx:04d}/{step:04d}.png',
+    'final': 'hats_imgs_{idx:04d}/final.png',
+    'completed_final': 'completed_{idx:04d}/final.png',
+    'interp': 'hats_imgs_{idx:04d}/{step:01d}_interp.png',
+}
+# kinds recomposed from gt, mask and the generated images
+DERIVED = {'masked': 'gt', 'completed': 'hats', 'completed_final': 'final'}
+
+
+def to_uint8(images):
+    """[-1, 1] images to uint8."""
+    return np.clip(np.round((np.asarray(images) + 1.) * 127.5), 0, 255).astype(np.uint8)
+
+
+def from_uint8(images):
+    return np.asarray(images).astype(np.float32) / 127.5 - 1.
+
+
+def grid_size(n):
+    return [int(np.ceil(n/8)), min(8, n)]
+
+
+class TrajectoryStore(object):
+    """Chunked, compressed array store in a directory of zip files.
+
+    Archive `{batch:04d}.zip` holds array `key` of batch `batch` as member
+    `{key}.npy`. `append` writes a batch's archive under a temporary name
+    and renames it into place, so a batch is either complete or absent;
+    batches already written are never rewritten.
+    """
+    def __init__(self, path, mode='r'):
+        assert(mode in ('r', 'a'))
+        self.path = path
+        self.mode = mode
+        if mode == 'a' and not os.path.exists(path):
+            os.makedirs(path)
+
+    def _batch_path(self, batch):
+        return os.path.join(self.path, '{:04d}.zip'.format(batch))
+
+    def append(self, batch, arrays):
+        assert(self.mode == 'a')
+        path = self._batch_path(batch)
+        if os.path.exists(path):
+            raise ValueError("%s already holds batch %d" % (self.path, batch))
+        tmp_path = path + '.tmp'
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as z:
+            for key in sorted(arrays):
+                buf = io.BytesIO()
+                np.save(buf, np.asarray(arrays[key]), allow_pickle=False)
+                z.writestr(key + '.npy', buf.getvalue())
+        os.rename(tmp_path, path)
+
+    def batches(self):
+        names = os.listdir(self.path) if os.path.isdir(self.path) else []
+        return sorted(int(n[:-len('.zip')]) for n in names
+                      if n.endswith('.zip') and n[:-len('.zip')].isdigit())
+
+    def keys(self, batch):
+        with zipfile.ZipFile(self._batch_path(batch), 'r') as z:
+            return sorted(n[:-len('.npy')] for n in z.namelist())
+
+    def read(self, batch, key):
+        with zipfile.ZipFile(self._batch_path(batch), 'r') as z:
+            data = z.read(key + '.npy')
+        return np.load(io.BytesIO(data), allow_pickle=False)
+
+    def close(self):
+        pass
+
+
+class PngOutput(object):
+    """Png grids and text files, one directory pair per batch."""
+    def __init__(self, out_dir, image_writer):
+        self.out_dir = out_dir
+        self.image_writer = image_writer
+
+    def begin_batch(self, idx, files, attributes, mask):
+        self.idx = idx
+        self.files = [os.path.basename(f) for f in files]
+        self.grid = grid_size(len(files))
+        for d in ('hats_imgs_{:04d}', 'completed_{:04d}'):
+            os.makedirs(os.path.join(self.out_dir, d.format(idx)))
+        with open(os.path.join(self.out_dir, 'completed_{:04d}/texts.txt'.format(idx)), 'wb') as f:
+            np.savetxt(f, attributes, fmt='%i', delimiter='\t')
+
+    def images(self, kind, images, step=None):
+        path = os.path.join(self.out_dir, PNG_PATHS[kind].format(idx=self.idx, step=step))
+        self.image_writer.save_images(images, self.grid, path)
+
+    def losses(self, step, loss):
+        pass
+
+    def kl_init(self, kl_rounds, kl_chosen):
+        with open(os.path.join(self.out_dir, 'hats_imgs_{:04d}/kld_init.txt'.format(self.idx)), 'w') as f:
+            f.write('average kl divergence of initializations:')
+            for i in xrange(len(kl_rounds)):
+                f.write('{:02d}: {:04.4f}'.format(i, kl_rounds[i]))
+            f.write('choosing min KL divergence: {:04.4f}'.format(kl_chosen))
+
+    def result(self, z_init, z_final, final_loss, restart=None):
+        if restart is None:
+            return
+        with open(os.path.join(self.out_dir, 'completed_{:04d}/restarts.txt'.format(self.idx)), 'w') as f:
+            for name, r, l in zip(self.files, restart, final_loss):
+                f.write('{}\t{:d}\t{:.6f}\n'.format(name, r, l))
+
+    def end_batch(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StoreOutput(object):
+    """Collects a batch's images, losses and latent vectors in memory and
+    appends them to a `TrajectoryStore` (through `image_writer`) when the
+    batch ends."""
+    def __init__(self, out_dir, image_writer, name=STORE_NAME):
+        self.store = TrajectoryStore(os.path.join(out_dir, name), 'a')
+        self.image_writer = image_writer
+
+    def begin_batch(self, idx, files, attributes, mask):
+        self.idx = idx
+        self.frames = {}
+        self.steps = {}
+        self.arrays = {'files': np.array([os.path.basename(f) for f in files]),
+                       'attributes': np.asarray(attributes, dtype=np.float32),
+                       'mask': np.asarray(mask, dtype=np.uint8)}
+
+    def images(self, kind, images, step=None):
+        if kind in DERIVED:
+            return
+        self.frames.setdefault(kind, []).append(to_uint8(images))
+        if step is not None:
+            self.steps.setdefault(kind, []).append(step)
+
+    def losses(self, step, loss):
+        self.frames.setdefault('loss', []).append(np.asarray(loss, dtype=np.float32))
+        self.steps.setdefault('loss', []).append(step)
+
+    def kl_init(self, kl_rounds, kl_chosen):
+        self.arrays['kl_init'] = np.asarray(kl_rounds, dtype=np.float32)
+        self.arrays['kl_chosen'] = np.float32(kl_chosen)
+
+    def result(self, z_init, z_final, final_loss, restart=None):
+        self.arrays['z_init'] = np.asarray(z_init, dtype=np.float32)
+        self.arrays['z_final'] = np.asarray(z_final, dtype=np.float32)
+        self.arrays['final_loss'] = np.asarray(final_loss, dtype=np.float32)
+        if restart is not None:
+            self.arrays['restart'] = np.asarray(restart, dtype=np.int32)
+
+    def end_batch(self):
+        arrays = self.arrays
+        for kind, frames in self.frames.items():
+            # single images are stored as they are, trajectories stacked
+            arrays[kind] = frames[0] if kind not in self.steps else np.stack(frames)
+        for kind, steps in self.steps.items():
+            arrays[kind + '_steps'] = np.array(steps, dtype=np.int32)
+        self.image_writer.submit(self.store.append, self.idx, arrays)
+
+    def close(self):
+        """Waits for the pending appends; safe to call more than once."""
+        self.image_writer.flush()
+        self.store.close()
+
+
+def export_pngs(store, out_dir, batches=None):
+    """Renders the stored batches in the `PngOutput` layout."""
+    out = PngOutput(out_dir, AsyncImageWriter(0))
+    for idx in (store.batches() if batches is None else batches):
+        keys = set(store.keys(idx))
+        mask = store.read(idx, 'mask').astype(np.float32)
+        out.begin_batch(idx, store.read(idx, 'files'), store.read(idx, 'attributes'), mask)
+        gt = from_uint8(store.read(idx, 'gt'))
+        out.images('gt', gt)
+        out.images('masked', gt*mask)
+        for kind in ('init', 'hats', 'interp'):
+            if kind not in keys:
+                continue
+            frames = from_uint8(store.read(idx, kind))
+            for step, images in zip(store.read(idx, kind + '_steps'), frames):
+                out.images(kind, images, step=int(step))
+                if kind == 'hats':
+                    out.images('completed', gt*mask + images*(1.-mask), step=int(step))
+        if 'chosen_init' in keys:
+            out.images('chosen_init', from_uint8(store.read(idx, 'chosen_init')))
+        if 'final' in keys:
+            final = from_uint8(store.read(idx, 'final'))
+            out.images('final', final)
+            out.images('completed_final', gt*mask + final*(1.-mask))
+        if 'kl_init' in keys:
+            out.kl_init(store.read(idx, 'kl_init'), store.read(idx, 'kl_chosen'))
+        if 'final_loss' in keys:
+            out.result(None, None, store.read(idx, 'final_loss'),
+                       store.read(idx, 'restart') if 'restart' in keys else None)
+        print(" [*] Exported batch %d" % idx)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('store', type=str)
+    parser.add_argument('--outDir', type=str, required=True)
+    parser.add_argument('--batches', nargs='+', type=int, default=None) # all batches if not given
+    args = parser.parse_args()
+
+    store = TrajectoryStore(args.store)
+    export_pngs(store, args.outDir, args.batches)
+    store.close()
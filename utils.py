@@ -8,12 +8,17 @@
 Some codes from https://github.com/Newmu/dcgan_code
 """
 from __future__ import division
+import sys
 import math
 import json
 import random
 import pprint
 import scipy.misc
 import numpy as np
+try:
+    import resource
+except ImportError:
+    resource = None
 from time import gmtime, strftime
 
 import pdb
@@ -69,6 +74,7 @@ def inverse_transform(images):
 
 
 def to_json(output_path, *layers):
+    # text export for the js runtime, see weights_io for the binary export
     with open(output_path, "w") as layer_f:
         lines = ""
         for w, b, bn in layers:
@@ -212,5 +218,38 @@ def get_text_batch(image_path, text_data):
     else:
         return text_data[idx]
 
+def kl_divergence_rows(p, q):
+    """KL(p || q) of every row pair, each row normalized to sum to 1
+    (row-wise `scipy.stats.entropy(p, q)`)."""
+    p = p / np.sum(p, axis=1, keepdims=True)
+    q = q / np.sum(q, axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sum(np.where(p > 0, p * np.log(p / q), 0.), axis=1)
+
 def rgb2gray(rgb):
-    return np.dot(rgb[...,:3], [0.2989, 0.5870, 0.1140])
\ No newline at end of file
+    return np.dot(rgb[...,:3], [0.2989, 0.5870, 0.1140])
+
+def best_slots(values, n, K):
+    """Index of the lowest of `values` within each of the first `n` groups
+    of `K` consecutive slots."""
+    values = np.asarray(values)[:n*K].reshape(n, K)
+    return np.argmin(values, 1) + np.arange(n)*K
+
+def fold_batch_norm(w, biases, mean, var, beta, gamma, epsilon=1e-5):
+    """Folds an inference-mode `batch_norm` following a `conv2d_transpose`
+    into its filter ([height, width, output_channels, in_channels]) and
+    biases, as numpy arrays:
+
+        gamma * (deconv(x, w) + b - mean) / sqrt(var + eps) + beta
+            = deconv(x, w * s) + (b - mean) * s + beta,  s = gamma / sqrt(var + eps)
+    """
+    scale = gamma / np.sqrt(var + epsilon)
+    return w * scale.reshape(1, 1, -1, 1), (biases - mean) * scale + beta
+
+def max_rss_mb():
+    """Peak resident memory of this process in MB, nan where unknown."""
+    if resource is None:
+        return float('nan')
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss / 2.**20 if sys.platform == 'darwin' else rss / 2.**10
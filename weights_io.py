@@ -0,0 +1,208 @@
+"""
+Binary generator weight export, the compact successor of `utils.to_json`.
+
+File layout:
+
+    magic 'STXW' | uint32 version | uint64 offset of the json header
+    tensor data, 16-byte aligned, written layer by layer
+    json header
+
+The header holds the layer metadata of `to_json` (layer type, kernel
+size, stride, depths, output size, batch norm parameters) plus, for every
+tensor, its dtype, shape and offset. With quantization the fc and deconv
+weights are stored as int8 with one float32 scale per output channel;
+biases and batch norm parameters stay float32. Layers are fetched and
+written one at a time, and the header offset is patched in at the end.
+
+    python weights_io.py --checkpointDir checkpoints_face_pretrained --text_vector_dim 18 \
+        --outPath generator.bin --quantize
+"""
+from __future__ import division
+from __future__ import print_function
+import os
+import json
+import struct
+import argparse
+import numpy as np
+
+from utils import fold_batch_norm
+
+MAGIC = b'STXW'
+VERSION = 1
+PREAMBLE = struct.Struct('<4sIQ')
+ALIGN = 16
+
+
+def quantize_channels(w, axis):
+    """Symmetric int8 quantization with one scale per index of `axis`."""
+    w = np.asarray(w, dtype=np.float32)
+    reduce_axes = tuple(i for i in range(w.ndim) if i != axis)
+    scale = np.max(np.abs(w), axis=reduce_axes) / 127.
+    scale[scale == 0] = 1.
+    shape = [1]*w.ndim
+    shape[axis] = -1
+    q = np.clip(np.round(w / scale.reshape(shape)), -127, 127).astype(np.int8)
+    return q, scale.astype(np.float32)
+
+
+def dequantize_channels(q, scale, axis):
+    shape = [1]*q.ndim
+    shape[axis] = -1
+    return q.astype(np.float32) * scale.reshape(shape)
+
+
+class WeightWriter(object):
+    """Streams layers into a weight file; `close` writes the header."""
+    def __init__(self, path, quantize=False, **meta):
+        self.path = path
+        self.quantize = quantize
+        self.header = dict(meta, format='stext2image-weights', version=VERSION,
+                           quantized=quantize, layers=[])
+        self._f = open(path, 'wb')
+        self._f.write(PREAMBLE.pack(MAGIC, VERSION, 0))
+
+    def _write(self, array):
+        pad = -self._f.tell() % ALIGN
+        self._f.write(b'\0' * pad)
+        offset = self._f.tell()
+        array = np.ascontiguousarray(array)
+        self._f.write(array.tobytes())
+        return {'dtype': array.dtype.name, 'shape': list(array.shape), 'offset': offset}
+
+    def add_layer(self, name, layer_type, tensors, quantize_axis=None, **meta):
+        """Writes `tensors` (name -> array) of one layer. The 'w' tensor is
+        quantized along `quantize_axis` if the file is quantized."""
+        entries = {}
+        for key in sorted(tensors):
+            value = np.asarray(tensors[key], dtype=np.float32)
+            if key == 'w' and self.quantize and quantize_axis is not None:
+                q, scale = quantize_channels(value, quantize_axis)
+                entries[key] = self._write(q)
+                entries[key]['scale'] = self._write(scale)
+                entries[key]['axis'] = quantize_axis
+            else:
+                entries[key] = self._write(value)
+        self.header['layers'].append(dict(meta, name=name, layer_type=layer_type, tensors=entries))
+
+    def close(self):
+        offset = self._f.tell()
+        self._f.write(json.dumps(self.header, separators=(',', ':')).encode('utf-8'))
+        self._f.seek(0)
+        self._f.write(PREAMBLE.pack(MAGIC, VERSION, offset))
+        self._f.close()
+
+
+class WeightFile(object):
+    """Random-access reader of a weight file."""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version, offset = PREAMBLE.unpack(f.read(PREAMBLE.size))
+            if magic != MAGIC:
+                raise ValueError("%s is not a weight file" % path)
+            if version > VERSION:
+                raise ValueError("%s has format version %d, newer than %d" % (path, version, VERSION))
+            f.seek(offset)
+            self.header = json.loads(f.read().decode('utf-8'))
+        self.layers = self.header['layers']
+        self._by_name = dict((l['name'], l) for l in self.layers)
+
+    def layer(self, name):
+        return self._by_name[name]
+
+    def _read(self, entry):
+        count = int(np.prod(entry['shape']))
+        with open(self.path, 'rb') as f:
+            f.seek(entry['offset'])
+            array = np.fromfile(f, dtype=np.dtype(entry['dtype']), count=count)
+        return array.reshape(entry['shape'])
+
+    def tensor(self, name, key, dequantize=True):
+        """Tensor `key` of layer `name`; quantized weights come back as
+        float32 unless `dequantize` is False, then as (int8, scale, axis)."""
+        entry = self._by_name[name]['tensors'][key]
+        array = self._read(entry)
+        if 'scale' not in entry:
+            return array
+        scale = self._read(entry['scale'])
+        if not dequantize:
+            return array, scale, entry['axis']
+        return dequantize_channels(array, scale, entry['axis'])
+
+    def folded_generator_weights(self):
+        """The weights in the layout of `GAN.folded_generator_weights`,
+        folding stored batch norm parameters."""
+        lin = self.layers[0]
+        deconvs = []
+        for layer in self.layers[1:]:
+            w, biases = self.tensor(layer['name'], 'w'), self.tensor(layer['name'], 'b')
+            if layer.get('batch_norm'):
+                w, biases = fold_batch_norm(w, biases, *[self.tensor(layer['name'], k) for k in
+                                                         ('mean', 'var', 'beta', 'gamma')],
+                                            epsilon=layer['batch_norm']['epsilon'])
+            deconvs.append((w, biases))
+        return self.tensor(lin['name'], 'w'), self.tensor(lin['name'], 'b'), deconvs
+
+
+def export_generator_weights(model, path, quantize=False, fold_bn=False):
+    """Writes the generator of the restored `model`, one layer per session
+    call; `fold_bn` stores batch norm folded into the deconv weights."""
+    # 'variables' is the global variables collection, this module imports no tensorflow
+    variables = dict((v.op.name, v) for v in model.sess.graph.get_collection('variables'))
+    bns = [model.g_bn0, model.g_bn1, model.g_bn2, model.g_bn3, None]
+    sizes = [(4, 8), (8, 16), (16, 32), (32, 64), (64, 128)]
+    writer = WeightWriter(path, quantize, folded=fold_bn, z_dim=model.z_dim,
+                          text_vector_dim=model.text_vector_dim, gf_dim=model.gf_dim,
+                          image_size=model.image_size)
+
+    lin_w, lin_b = model.sess.run([variables['g_h0_lin/Matrix'], variables['g_h0_lin/bias']])
+    writer.add_layer('g_h0_lin', 'fc', {'w': lin_w, 'b': lin_b}, quantize_axis=1,
+                     in_depth=lin_w.shape[0], out_depth=lin_w.shape[1],
+                     reshape=[4, 8, model.gf_dim], activation=None)
+    if fold_bn:
+        _, _, folded = model.folded_generator_weights()
+    for i, (bn, (out_sy, out_sx)) in enumerate(zip(bns, sizes)):
+        name = 'g_h%d' % i
+        if fold_bn:
+            tensors = dict(zip(('w', 'b'), folded[i]))
+        else:
+            fetches = [variables[name + '/w'], variables[name + '/biases']]
+            if bn is not None:
+                fetches += [bn.ema_mean, bn.ema_var, bn.beta, bn.gamma]
+            tensors = dict(zip(('w', 'b', 'mean', 'var', 'beta', 'gamma'), model.sess.run(fetches)))
+        w = tensors['w']
+        writer.add_layer(name, 'deconv', tensors, quantize_axis=2,
+                         sy=w.shape[0], sx=w.shape[1], stride=1 if i == 0 else 2, padding='SAME',
+                         in_depth=w.shape[3], out_depth=w.shape[2], out_sy=out_sy, out_sx=out_sx,
+                         batch_norm={'epsilon': bn.epsilon} if bn is not None and not fold_bn else None,
+                         activation='relu' if bn is not None else 'tanh')
+    writer.close()
+    print(" [*] Wrote %s generator weights to %s (%.1f MB)" % (
+        'int8' if quantize else 'float32', path, os.path.getsize(path) / 2.**20))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--imgSize', type=int, default=64)
+    parser.add_argument('--text_vector_dim', type=int, default=100)
+    parser.add_argument('--checkpointDir', type=str, default='checkpoint')
+    parser.add_argument('--outPath', type=str, default='generator.bin')
+    parser.add_argument('--quantize', action='store_true') # int8 weights with per-channel scales
+    parser.add_argument('--foldBN', action='store_true') # store batch norm folded into the deconv weights
+    args = parser.parse_args()
+
+    assert(os.path.exists(args.checkpointDir))
+
+    import tensorflow as tf
+    from model import GAN
+
+    with tf.Session() as sess:
+        model = GAN(sess,
+                    image_size=args.imgSize,
+                    text_vector_dim=args.text_vector_dim,
+                    checkpoint_dir=args.checkpointDir,
+                    inference=True,
+                   )
+        isLoaded = model.load(args.checkpointDir)
+        assert(isLoaded)
+        export_generator_weights(model, args.outPath, args.quantize, args.foldBN)